@@ -0,0 +1,86 @@
+import sys
+import unittest
+from inspect import Parameter, Signature
+from os import path
+from typing import Optional, Sequence, Union
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import vapoursynth as vs  # noqa: E402
+
+from vsgenstubs4.init import clean_signature  # noqa: E402
+
+# Signatures as str() renders them for real plugins, and the stubs expected for them.
+# The expected side was produced by the replace-chain cleaner the regex passes replaced.
+golden_signatures = [
+    (
+        "(clip: vapoursynth.VideoNode, planes: Union[int, Sequence[int], NoneType] = None) -> vapoursynth.VideoNode",
+        "(clip: 'VideoNode', planes: Optional[SingleAndSequence[int]] = None) -> 'VideoNode'"
+    ),
+    (
+        "(clip: vapoursynth.VideoNode, radius: Union[int, NoneType] = None, "
+        "thr: Union[float, Sequence[float], NoneType] = None) -> vapoursynth.VideoNode",
+        "(clip: 'VideoNode', radius: Optional[int] = None, thr: Optional[SingleAndSequence[float]] = None) -> 'VideoNode'"
+    ),
+    (
+        "(clips: Union[vapoursynth.VideoNode, Sequence[vapoursynth.VideoNode]], "
+        "mismatch: Union[int, NoneType] = None) -> vapoursynth.VideoNode",
+        "(clips: SingleAndSequence['VideoNode'], mismatch: Optional[int] = None) -> 'VideoNode'"
+    ),
+    (
+        "(clip: vapoursynth.AudioNode, frame: Union[vapoursynth.VideoFrame, NoneType] = None) -> vapoursynth.AudioNode",
+        "(clip: 'AudioNode', frame: Optional['VideoFrame'] = None) -> 'AudioNode'"
+    ),
+    (
+        "(clip: vapoursynth.VideoNode, prop: typing.Union[str, bytes, bytearray], "
+        "data: Union[str, bytes, bytearray, Sequence[Union[str, bytes, bytearray]], NoneType] = None) -> vapoursynth.VideoNode",
+        "(clip: 'VideoNode', prop: DataType, data: Optional[SingleAndSequence[DataType]] = None) -> 'VideoNode'"
+    ),
+    (
+        "(clip: vapoursynth.VideoNode, selector: typing.Union[vapoursynth.Func, typing.Callable]) -> vapoursynth.VideoNode",
+        "(clip: 'VideoNode', selector: VSMapValueCallback[_VapourSynthMapValue]) -> 'VideoNode'"
+    ),
+    (
+        "(clip: vapoursynth.VideoNode, eval: typing.Union[vapoursynth.Func, typing.Callable, NoneType] = None) "
+        "-> vapoursynth.VideoNode",
+        "(clip: 'VideoNode', eval: Optional[VSMapValueCallback[_VapourSynthMapValue]] = None) -> 'VideoNode'"
+    ),
+    (
+        "(clip: vapoursynth.VideoNode, *, lambda: Union[float, NoneType] = None, class: int, "
+        "from: Union[int, NoneType] = None, def: int) -> vapoursynth.VideoNode",
+        "(clip: 'VideoNode', *, lambda_: Optional[float] = None, class_: int, from_: Optional[int] = None, def_: int) "
+        "-> 'VideoNode'"
+    ),
+    (
+        "(clip: Union[vapoursynth.RawNode, NoneType] = None, **kwargs: Any) -> vapoursynth.VideoNode",
+        "(clip: Optional[RawNode] = None, **kwargs: Any) -> 'VideoNode'"
+    ),
+    (
+        "() -> Any",
+        "() -> Any"
+    ),
+]
+
+
+class CleanSignatureTest(unittest.TestCase):
+    def test_golden_signatures(self) -> None:
+        for signature, expected in golden_signatures:
+            with self.subTest(signature=signature):
+                self.assertEqual(clean_signature(signature), expected)
+
+    def test_signature_object(self) -> None:
+        signature = Signature([
+            Parameter('clip', Parameter.POSITIONAL_OR_KEYWORD, annotation=vs.VideoNode),
+            Parameter('planes', Parameter.KEYWORD_ONLY, annotation=Union[int, Sequence[int], None], default=None),
+            Parameter('frame', Parameter.KEYWORD_ONLY, annotation=Optional[vs.VideoFrame], default=None),
+        ], return_annotation=vs.VideoNode)
+
+        self.assertEqual(
+            clean_signature(signature),
+            "(clip: 'VideoNode', *, planes: Optional[SingleAndSequence[int]] = None, "
+            "frame: Optional['VideoFrame'] = None) -> 'VideoNode'"
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
 from vapoursynth import core, GRAYS, RGBS, GRAY, YUV, RGB
+from typing import NamedTuple
 
 # If yuv444 is True chroma will be upscaled instead of downscaled
 # If gray is True the output will be grayscale
@@ -49,6 +50,158 @@ def Descale(src, width, height, kernel=None, custom_kernel=None, taps=None, b=No
     return core.std.ShufflePlanes([y,uv], [0,1,2], YUV)
 
 
+# Native resolution detection
+#
+# Every candidate (height, kernel) descales a few sample frames and scales them back up with the
+# same kernel, the native resolution is where the error dips below the heights around it.
+# The sample frames are decoded once and fed to all the candidates from memory.
+
+DETECT_KERNELS = (
+    dict(kernel='bilinear'),
+    dict(kernel='bicubic', b=1/3, c=1/3),
+    dict(kernel='bicubic', b=0.0, c=0.5),
+    dict(kernel='bicubic', b=0.0, c=1.0),
+    dict(kernel='lanczos', taps=3),
+    dict(kernel='spline36'),
+)
+
+class NativeCandidate(NamedTuple):
+    width: int
+    height: int
+    kernel: str
+    taps: int
+    b: float
+    c: float
+    error: float
+    # Error divided by the median error of the neighbouring heights, lower means a sharper dip
+    score: float
+
+class NativeDetection(NamedTuple):
+    # Best candidate first
+    candidates: list
+    # Kernel label -> (heights, errors) arrays
+    curves: dict
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError('DetectNative: NumPy is required for the native resolution detection.') from None
+    return numpy
+
+def kernel_args(kernel, taps=None, b=None, c=None):
+    # The defaults of Debicubic and Delanczos, so the rescale uses exactly the descale kernel
+    if kernel == 'bicubic':
+        return kernel, None, 0.0 if b is None else b, 0.5 if c is None else c
+    if kernel == 'lanczos':
+        return kernel, 3 if taps is None else taps, None, None
+    return kernel, None, None, None
+
+def kernel_label(kernel, taps=None, b=None, c=None):
+    if kernel == 'bicubic':
+        return f'bicubic b={b:.2f} c={c:.2f}'
+    if kernel == 'lanczos':
+        return f'lanczos taps={taps}'
+    return kernel
+
+def descale_width(src, height):
+    # Same aspect ratio, keeping the parity of the source width so the image stays centered
+    width = round(src.width * height / src.height)
+    if (src.width - width) % 2:
+        width += 1 if src.width * height / src.height > width else -1
+    return width
+
+def rescale(clip, width, height, kernel, taps=None, b=None, c=None):
+    # Upscale with the kernel the clip was descaled with
+    if kernel == 'bilinear':
+        return clip.resize.Bilinear(width, height)
+    if kernel == 'bicubic':
+        return clip.resize.Bicubic(width, height, filter_param_a=b, filter_param_b=c)
+    if kernel == 'lanczos':
+        return clip.resize.Lanczos(width, height, filter_param_a=taps)
+    if kernel in ('spline16', 'spline36', 'spline64'):
+        return getattr(clip.resize, kernel.capitalize())(width, height)
+    raise ValueError(f'DetectNative: Unknown kernel {kernel}.')
+
+def get_sample_frames(src, frames=None, num_frames=5):
+    # Luma of the sample frames as float32 arrays, evenly spread over the clip unless given
+    np = _import_numpy()
+    if frames is None:
+        num_frames = min(num_frames, src.num_frames)
+        frames = [(i + 1) * src.num_frames // (num_frames + 1) for i in range(num_frames)]
+    sample = core.std.Splice([src[n] for n in frames]) if len(frames) > 1 else src[frames[0]]
+    sample = to_grays(sample)
+    return [np.array(frame[0], dtype=np.float32) for frame in sample.frames(close=True)]
+
+def frames_to_clip(planes):
+    # GRAYS clip serving the decoded sample frames, so the candidates don't decode the source again
+    np = _import_numpy()
+    height, width = planes[0].shape
+    blank = core.std.BlankClip(width=width, height=height, format=GRAYS, length=len(planes), keep=True)
+
+    def _copy(n, f):
+        fout = f.copy()
+        np.copyto(np.asarray(fout[0]), planes[n])
+        return fout
+
+    return core.std.ModifyFrame(blank, blank, _copy)
+
+def _local_scores(errors, radius):
+    # Each error against the median of the errors within radius heights, itself excluded
+    np = _import_numpy()
+    padded = np.pad(errors, radius, mode='edge')
+    windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * radius + 1)
+    neighbours = np.delete(windows, radius, axis=1)
+    return errors / np.maximum(np.median(neighbours, axis=1), 1e-12)
+
+def DetectNative(src, heights=None, kernels=DETECT_KERNELS, frames=None, num_frames=5, batch=64, radius=5):
+    # heights defaults to every height from half the source height up to just below it,
+    # kernels are dicts of the Descale arguments (kernel, taps, b, c)
+    np = _import_numpy()
+    if heights is None:
+        heights = range(src.height // 2, src.height)
+    heights = sorted({h for h in heights if 0 < h < src.height})
+    if not heights:
+        raise ValueError('DetectNative: No height below the source height to test.')
+
+    planes = get_sample_frames(src, frames, num_frames)
+    sample = frames_to_clip(planes)
+    reference = np.stack(planes)
+
+    kernels = [kernel_args(k['kernel'], k.get('taps'), k.get('b'), k.get('c')) for k in kernels]
+    candidates = [(descale_width(src, h), h) + k for k in kernels for h in heights]
+
+    # One spliced clip per batch, VapourSynth renders the frames of all its candidates in parallel
+    errors = np.empty(len(candidates), dtype=np.float64)
+    per_candidate = np.empty(len(planes), dtype=np.float64)
+    for start in range(0, len(candidates), batch):
+        chunk = candidates[start:start + batch]
+        clips = [
+            rescale(sample.descale.Descale(w, h, kernel, None, taps, b, c), src.width, src.height, kernel, taps, b, c)
+            for w, h, kernel, taps, b, c in chunk
+        ]
+        spliced = core.std.Splice(clips) if len(clips) > 1 else clips[0]
+        for n, frame in enumerate(spliced.frames(close=True)):
+            i, j = divmod(n, len(planes))
+            per_candidate[j] = np.abs(np.asarray(frame[0]) - reference[j]).mean()
+            if j == len(planes) - 1:
+                errors[start + i] = per_candidate.mean()
+
+    results = []
+    curves = {}
+    for k, kernel in enumerate(kernels):
+        kernel_errors = errors[k * len(heights):(k + 1) * len(heights)]
+        scores = _local_scores(kernel_errors, radius)
+        curves[kernel_label(*kernel)] = (np.array(heights), kernel_errors)
+        for (w, h, name, taps, b, c), error, score in zip(
+            candidates[k * len(heights):(k + 1) * len(heights)], kernel_errors, scores
+        ):
+            results.append(NativeCandidate(w, h, name, taps, b, c, float(error), float(score)))
+
+    results.sort(key=lambda r: (r.score, r.error))
+    return NativeDetection(results, curves)
+
+
 # Helpers
 
 def to_grays(src):
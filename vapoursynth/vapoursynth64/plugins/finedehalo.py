@@ -1,6 +1,11 @@
 import vapoursynth as vs
 import havsfunc as haf
-import mvsfunc as mvs
+
+# Only needed to show the masks
+try:
+    import mvsfunc as mvs
+except ImportError:
+    mvs = None
 
 __no_chroma = (0,)
 
@@ -39,6 +44,53 @@ def _mk_coordinates_list(sw, sh, mode=RECTANGLE):
         clist.append(coordinates)
     return clist
 
+# Neighbours of the coordinates argument of std.Minimum/Maximum
+__offsets = ((-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1))
+
+# Above this many pixels per output pixel a non separable shape stays a chain
+__max_fused_taps = 81
+
+def _mk_footprint(clist):
+    # Minkowski sum of the 3x3 steps, the pixels one fused min/max has to look at
+    footprint = {(0, 0)}
+    for coordinates in clist:
+        step = [(0, 0)] + [offset for offset, used in zip(__offsets, coordinates) if used]
+        footprint = {(x + dx, y + dy) for x, y in footprint for dx, dy in step}
+    return footprint
+
+def _mk_fused_expr(footprint, op):
+    # x[dx,dy]:c reads clamped at the edges, the same as min/max over the pixels inside the frame
+    terms = [f"x[{dx},{dy}]:c" for dx, dy in sorted(footprint, key=lambda o: (o[1], o[0]))]
+    return " ".join(terms[:1] + [f"{term} {op}" for term in terms[1:]])
+
+def _fused_xxpand(core, clip, xxpand_mode, clist, planes):
+    # The whole chain in one Expr per direction, None if it can't be done here
+    footprint = _mk_footprint(clist)
+    op = "min" if xxpand_mode == 0 else "max"
+    expr = core.akarin.Expr
+    planes = [planes] if isinstance(planes, int) else planes
+
+    xs = [x for x, _ in footprint]
+    ys = [y for _, y in footprint]
+    rows = {(x, 0) for x in range(min(xs), max(xs) + 1)}
+    cols = {(0, y) for y in range(min(ys), max(ys) + 1)}
+    if len(footprint) == len(rows) * len(cols):
+        # A rectangle is separable, a row pass and a column pass
+        passes = [taps for taps in (rows, cols) if len(taps) > 1]
+    elif len(footprint) <= __max_fused_taps:
+        passes = [footprint]
+    else:
+        return None
+
+    try:
+        out = clip
+        for taps in passes:
+            out = expr(out, expr=[_mk_fused_expr(taps, op) if p in planes else "" for p in range(clip.format.num_planes)])
+        return out
+    except vs.Error:
+        # An akarin build without clamped relative pixel access
+        return None
+
 # mode: 0 to inpand, 1 to expand
 def _xxpand(clip, xxpand_mode, sw=1, sh=None, thr=255, mode=RECTANGLE, planes=(0,1,2)):
     core = vs.get_core()
@@ -50,14 +102,37 @@ def _xxpand(clip, xxpand_mode, sw=1, sh=None, thr=255, mode=RECTANGLE, planes=(0
     assert sw >= 0, "sw: must be positive int"
     assert sh >= 0, "sh: must be positive int"
 
+    clist = _mk_coordinates_list(sw, sh, mode=mode)
+
+    # The threshold limits every step of the chain, only without one the steps can be fused
+    # std.Expr has no relative pixel access, only akarin.Expr can do it in one pass
+    if thr == 255 and clist and hasattr(core, 'akarin'):
+        out = _fused_xxpand(core, clip, xxpand_mode, clist, planes)
+        if out is not None:
+            return out
+
     thr = haf.scale(thr, clip.format.bits_per_sample)
     func = core.std.Minimum if xxpand_mode == 0 else core.std.Maximum
 
     out = clip
-    for coordinates in _mk_coordinates_list(sw, sh, mode=mode):
+    for coordinates in clist:
         out = func(out, planes=planes, threshold=thr, coordinates=coordinates)
     return out
     
+# 3x3 average of the luma, std.Convolution when RemoveGrainVS isn't installed
+def _smooth(core, clip):
+    if hasattr(core, 'rgvs'):
+        return core.rgvs.RemoveGrain(clip, mode=(20, 0))
+    return core.std.Convolution(clip, matrix=[1] * 9, planes=__no_chroma)
+
+def _grayscale(clip):
+    if mvs is not None:
+        return mvs.GrayScale(clip)
+    if clip.format.color_family != vs.YUV:
+        return clip
+    neutral = 0 if clip.format.sample_type == vs.FLOAT else 1 << (clip.format.bits_per_sample - 1)
+    return vs.core.std.Expr(clip, expr=("", str(neutral)))
+    
 def inpand(clip, *args, **kwargs):
     return _xxpand(clip, 0, *args, **kwargs)
     
@@ -125,8 +200,8 @@ def fine_dehalo(clip, rx=2.0, ry=None, thmi=80, thma=128, thlimi=50, thlima=100,
     
     # This mask is almost binary, which will produce distinct
     # discontinuities once applied. Then we have to smooth it.
-    shrink = core.rgvs.RemoveGrain(shrink, mode=(20, 0))
-    shrink = core.rgvs.RemoveGrain(shrink, mode=(20, 0))
+    shrink = _smooth(core, shrink)
+    shrink = _smooth(core, shrink)
     
     ### Final mask building ###
 
@@ -149,22 +224,22 @@ def fine_dehalo(clip, rx=2.0, ry=None, thmi=80, thma=128, thlimi=50, thlima=100,
         
     # Smooth again and amplify to grow the mask a bit, otherwise the halo
     # parts sticking to the edges could be missed.
-    mask = core.rgvs.RemoveGrain(mask, (20, 0))
+    mask = _smooth(core, mask)
     mask = core.std.Expr([mask], expr=("x 2 *", "", ""))
     
     ### Masking ###
     if showmask == 1:
-        return mvs.GrayScale(mask)
+        return _grayscale(mask)
     elif showmask == 2:
-        return mvs.GrayScale(shrink)
+        return _grayscale(shrink)
     elif showmask == 3:
-        return mvs.GrayScale(edges)
+        return _grayscale(edges)
     elif showmask == 4:
-        return mvs.GrayScale(strong)
+        return _grayscale(strong)
     elif showmask == 5:
-        return mvs.GrayScale(light)
+        return _grayscale(light)
     elif showmask == 6:
-        return mvs.GrayScale(large)
+        return _grayscale(large)
     elif showmask == 7:
-        return mvs.GrayScale(shr_med)
+        return _grayscale(shr_med)
     return core.std.MaskedMerge(clip, dehaloed, mask, planes=__no_chroma, first_plane=True)
\ No newline at end of file
@@ -5,4 +5,5 @@ sys.path.append(os.path.dirname(__file__))
 
 from vsgenstubs4 import main
 
-main()
+if __name__ == '__main__':
+    main()
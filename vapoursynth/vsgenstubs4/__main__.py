@@ -1,3 +1,4 @@
 from .init import sys, main
 
-main(sys.argv[1:])
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,301 @@
+import json
+import platform
+import sys
+from argparse import ArgumentParser
+from inspect import Parameter, Signature
+from os.path import join as join_path
+from pathlib import Path
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import perf_counter, strftime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Union
+
+import vapoursynth as vs
+
+from .init import (
+    BoundSignature, CoreLike, PluginMeta, clean_signature, generate_template, make_blocks, output_stubs, parser as stubs_parser
+)
+
+__all__ = [
+    'main'
+]
+
+parser = ArgumentParser(description='Time the stub generation against a fake core with synthetic plugins.')
+parser.add_argument(
+    '--plugins', '-n',
+    type=int, nargs='+', default=[50, 200],
+    help='Number of synthetic plugins, one run per value.'
+)
+parser.add_argument(
+    '--functions', '-f',
+    type=int, default=8,
+    help='Number of functions of each synthetic plugin.'
+)
+parser.add_argument(
+    '--repeat', '-r',
+    type=int, default=7,
+    help='Runs per phase, the fastest one is kept.'
+)
+parser.add_argument(
+    '--history',
+    default='vsgenstubs4-bench.jsonl',
+    help='JSON lines file the results are appended to and compared against. Empty to not record them.'
+)
+parser.add_argument(
+    '--threshold', '-t',
+    type=float, default=0.1,
+    help='Flag a phase as a regression when it is slower than the recent runs by more than this fraction.'
+)
+parser.add_argument(
+    '--label', default='',
+    help='Stored with the results, e.g. the commit being measured.'
+)
+
+# Phases not worth flagging below this, in seconds
+min_regression = 0.002
+
+# Earlier runs of the same size needed before a phase is compared at all
+min_history_runs = 3
+
+# Annotations of the kinds the real plugins produce, cycled through by the synthetic functions
+annotations: List[Any] = [
+    int, float, Optional[int], Union[int, Sequence[int]], Union[int, Sequence[int], None],
+    Union[str, bytes, bytearray], Union[str, bytes, bytearray, None], Union[float, Sequence[float], None],
+    vs.VideoNode, Optional[vs.VideoNode], Union[vs.VideoNode, Sequence[vs.VideoNode]],
+    Union[vs.AudioNode, Sequence[vs.AudioNode], None], Optional[vs.VideoFrame],
+    Union[vs.Func, Callable], Union[vs.Func, Callable, None]
+]
+
+parameter_names = ['planes', 'radius', 'mode', 'thr', 'lambda', 'sigma', 'format', 'class', 'matrix', 'from']
+
+
+class FakeFunction:
+    def __init__(self, name: str, signature: Signature) -> None:
+        self.name = name
+        self.__signature__ = signature
+
+    # Signature.from_callable only accepts callables, the generator never calls it
+    def __call__(self, *args: Any, **kwargs: Any) -> Any:
+        raise TypeError('bench functions are not callable')
+
+
+class FakePlugin:
+    def __init__(self, namespace: str, name: str, functions: List[FakeFunction]) -> None:
+        self.namespace = namespace
+        self.name = name
+        self.identifier = f'com.vsgenstubs4.bench.{namespace}'
+        self.version = (1, 0)
+        self.plugin_path = None
+        self._functions = {func.name: func for func in functions}
+
+    def functions(self) -> Iterator[FakeFunction]:
+        return iter(self._functions.values())
+
+    def __dir__(self) -> List[str]:
+        return list(self._functions)
+
+    def __getattr__(self, name: str) -> FakeFunction:
+        try:
+            return self._functions[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+class FakeBound:
+    def __init__(self, plugins: List[FakePlugin]) -> None:
+        self._plugins = {plugin.namespace: plugin for plugin in plugins}
+
+    def plugins(self) -> Iterator[FakePlugin]:
+        return iter(self._plugins.values())
+
+    def __getattr__(self, name: str) -> FakePlugin:
+        try:
+            return self._plugins[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+def make_signature(i: int, j: int) -> Signature:
+    parameters = [Parameter('clip', Parameter.POSITIONAL_OR_KEYWORD, annotation=vs.VideoNode)] if j % 3 else []
+
+    for k in range(1 + (i + j) % 7):
+        parameters.append(Parameter(
+            f'{parameter_names[(i + j + k) % len(parameter_names)]}{k}',
+            Parameter.POSITIONAL_OR_KEYWORD if not parameters else Parameter.KEYWORD_ONLY,
+            annotation=annotations[(i * 7 + j * 3 + k) % len(annotations)]
+        ))
+
+    return Signature(parameters, return_annotation=[vs.VideoNode, vs.AudioNode, Any][(i + j) % 3])
+
+
+def make_fake_cores(num_plugins: int, num_functions: int) -> List[CoreLike]:
+    core_plugins: List[FakePlugin] = []
+    node_plugins: List[FakePlugin] = []
+    audio_plugins: List[FakePlugin] = []
+
+    for i in range(num_plugins):
+        namespace, name = f'bench{i:04d}', f'BenchPlugin{i:04d}'
+
+        functions = [FakeFunction(f'Filter{j}', make_signature(i, j)) for j in range(num_functions)]
+
+        core_plugins.append(FakePlugin(namespace, name, functions))
+
+        # Bound to a node the clip argument is taken from it, like the real video node plugins
+        node_plugins.append(FakePlugin(namespace, name, [
+            FakeFunction(func.name, func.__signature__.replace(parameters=list(func.__signature__.parameters.values())[1:]))
+            for func in functions if 'clip' in func.__signature__.parameters
+        ]))
+
+        # Every namespace is reachable from every core, only without functions there
+        audio_plugins.append(FakePlugin(namespace, name, []))
+
+    # The generator names the bound classes after the classes of the cores
+    core_class = type('Core', (FakeBound,), {})
+    video_class = type('VideoNode', (FakeBound,), {})
+    audio_class = type('AudioNode', (FakeBound,), {})
+
+    return [core_class(core_plugins), video_class(node_plugins), audio_class(audio_plugins)]
+
+
+def get_plugins(cores: Sequence[CoreLike]) -> List[PluginMeta]:
+    # A fresh list every run, the bound signatures keep what they introspected
+    return [PluginMeta(p.namespace, p.name, BoundSignature(p.namespace, cores)) for p in cores[0].plugins()]
+
+
+def time_best(func: Callable[[], Any], repeat: int) -> float:
+    best = float('inf')
+
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        best = min(best, perf_counter() - start)
+
+    return best
+
+
+def run_benchmark(num_plugins: int, num_functions: int, repeat: int) -> Dict[str, float]:
+    cores = make_fake_cores(num_plugins, num_functions)
+
+    functions = [
+        getattr(getattr(core, p.namespace), func.name)
+        for core in cores for p in core.plugins() for func in p.functions()
+    ]
+
+    signatures = [Signature.from_callable(func, follow_wrapped=True) for func in functions]
+
+    phases: Dict[str, float] = {}
+
+    with TemporaryDirectory(prefix='vsgenstubs4-bench') as tmp_dir:
+        stubs_path = join_path(tmp_dir, 'vapoursynth.pyi')
+
+        # Worker processes would load the real plugins, so everything runs in this one
+        args = stubs_parser.parse_args(['--output', stubs_path, '--capabilities', ''])
+
+        phases['introspect'] = time_best(
+            lambda: [Signature.from_callable(func, follow_wrapped=True) for func in functions], repeat
+        )
+
+        phases['clean'] = time_best(lambda: [clean_signature(signature) for signature in signatures], repeat)
+
+        phases['blocks'] = time_best(lambda: make_blocks(args, get_plugins(cores)), repeat)
+
+        implementations, instances = make_blocks(args, get_plugins(cores))
+
+        template: List[str] = []
+
+        def _assemble() -> None:
+            template[:] = generate_template(args, cores, list(implementations), list(instances))
+
+        phases['template'] = time_best(_assemble, repeat)
+
+        def _write() -> None:
+            with open(stubs_path, 'w') as f:
+                f.writelines(template)
+
+        phases['write'] = time_best(_write, repeat)
+
+        def _total() -> None:
+            # Without the previous run's stubs and manifest, nothing gets reused
+            Path(stubs_path).unlink(True)
+            Path(stubs_path + '.manifest.json').unlink(True)
+            output_stubs(args, cores, get_plugins(cores))
+
+        phases['total'] = time_best(_total, repeat)
+
+    return phases
+
+
+def load_history(history_path: str) -> List[Dict[str, Any]]:
+    try:
+        with open(history_path, 'r') as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except OSError:
+        return []
+
+
+def find_regressions(
+    history: List[Dict[str, Any]], result: Dict[str, Any], threshold: float
+) -> Dict[str, float]:
+    # Against the median of the last runs with the same sizes, so one noisy run doesn't move the baseline
+    previous = [
+        entry for entry in history
+        if entry['plugins'] == result['plugins'] and entry['functions'] == result['functions']
+    ][-5:]
+
+    regressions: Dict[str, float] = {}
+
+    for phase, seconds in result['phases'].items():
+        recorded = [entry['phases'][phase] for entry in previous if phase in entry['phases']]
+
+        if len(recorded) < min_history_runs:
+            continue
+
+        baseline = median(recorded)
+
+        if seconds - baseline > max(baseline * threshold, min_regression):
+            regressions[phase] = baseline
+
+    return regressions
+
+
+def main(argv: List[str] = sys.argv[1:]) -> int:
+    args = parser.parse_args(args=argv)
+
+    history = load_history(args.history) if args.history else []
+
+    regressed = False
+
+    for num_plugins in args.plugins:
+        phases = run_benchmark(num_plugins, args.functions, max(args.repeat, 1))
+
+        result = {
+            'time': strftime('%Y-%m-%dT%H:%M:%S'), 'label': args.label,
+            'python': platform.python_version(), 'vapoursynth': list(vs.__version__),
+            'plugins': num_plugins, 'functions': args.functions, 'phases': phases
+        }
+
+        regressions = find_regressions(history, result, args.threshold)
+
+        print(f'{num_plugins} plugins, {args.functions} functions each:')
+
+        for phase, seconds in phases.items():
+            line = f'    {phase:<12}{seconds * 1000:10.2f} ms'
+
+            if phase in regressions:
+                line += f'    REGRESSION, was {regressions[phase] * 1000:.2f} ms'
+
+            print(line)
+
+        regressed = regressed or bool(regressions)
+
+        history.append(result)
+
+        if args.history:
+            with open(args.history, 'a') as f:
+                f.write(json.dumps(result, sort_keys=True) + '\n')
+
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,63 @@
+import json
+from importlib.util import find_spec
+from os import path
+from os.path import join as join_path
+from typing import Any, Dict, NamedTuple, Optional
+
+__all__ = [
+    'Capabilities', 'default_capabilities_path', 'load_capabilities'
+]
+
+capabilities_version = 1
+
+
+def default_capabilities_path() -> Optional[str]:
+    # Next to the stubs package in site-packages, found without importing vapoursynth
+    spec = find_spec('vapoursynth')
+
+    if spec is None or spec.origin is None:
+        return None
+
+    return join_path(path.dirname(spec.origin), 'vapoursynth-stubs', 'capabilities.json')
+
+
+class Capabilities(NamedTuple):
+    plugins: Dict[str, Dict[str, Any]]
+
+    def has_plugin(self, namespace: str) -> bool:
+        plugin = self.plugins.get(namespace)
+
+        if plugin is None:
+            return False
+
+        # The binary may have been removed since the cache was written
+        return not plugin.get('path') or path.exists(plugin['path'])
+
+    def has_function(self, namespace: str, function: str) -> bool:
+        return self.has_plugin(namespace) and function in self.plugins[namespace]['functions']
+
+    def get_signature(self, namespace: str, function: str) -> Optional[str]:
+        if not self.has_plugin(namespace):
+            return None
+
+        return self.plugins[namespace]['functions'].get(function)
+
+
+def load_capabilities(capabilities_path: Optional[str] = None) -> Capabilities:
+    # Empty when vsgenstubs4 hasn't written the cache yet
+    if capabilities_path is None:
+        capabilities_path = default_capabilities_path()
+
+    if capabilities_path is None:
+        return Capabilities({})
+
+    try:
+        with open(capabilities_path, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return Capabilities({})
+
+    if cache.get('version') != capabilities_version:
+        return Capabilities({})
+
+    return Capabilities(cache['plugins'])
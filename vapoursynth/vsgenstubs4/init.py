@@ -1,20 +1,27 @@
+import json
+import multiprocessing
 import re
 import sys
 from abc import abstractmethod
 from argparse import ArgumentParser, Namespace
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
 from inspect import Parameter, Signature
 from itertools import chain
 from keyword import kwlist as reserved_keywords
-from os import SEEK_END, listdir, makedirs, path
+from locale import getpreferredencoding
+from os import SEEK_END, listdir, makedirs, path, replace, stat
 from os.path import join as join_path
 from pathlib import Path
 from typing import (
-    Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Protocol, Sequence, Tuple, TypedDict, TypeVar,
+    Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Protocol, Sequence, Tuple, TypedDict, TypeVar,
     Union, cast, runtime_checkable
 )
 
 import vapoursynth as vs
 
+from .capabilities import capabilities_version, default_capabilities_path, load_capabilities
+
 __all__ = [
     'main'
 ]
@@ -88,6 +95,16 @@ parser.add_argument(
     action='store_true',
     help='Force rewrite of the file.'
 )
+parser.add_argument(
+    '--capabilities', default='@',
+    help="Where to write the plugin capability cache. "
+    "The special value '@' puts it next to the stub-package inside site-packages, an empty value disables it."
+)
+parser.add_argument(
+    '--jobs', '-j',
+    type=int, default=1,
+    help='Number of worker processes introspecting plugins, each loads its own core.'
+)
 
 
 def indent(strings: Iterable[str], spaces: int = 4) -> str:
@@ -145,37 +162,70 @@ def load_plugins(args: Namespace) -> vs.Core:
     return vs.core.core
 
 
-def clean_signature(signature: Any) -> str:
-    signature = str(signature)
+def get_cores(core: vs.Core) -> List[CoreLike]:
+    return [core, core.std.BlankClip(), core.std.BlankAudio()]
 
-    # Clean up the type annotations so that they are valid python syntax.
-    signature = signature.replace('typing.', '')
-    signature = signature.replace('vapoursynth.', '').replace('vs.', '')
-    signature = signature.replace('VideoNode', "'VideoNode'").replace('VideoFrame', "'VideoFrame'")
-    signature = signature.replace('AudioNode', "'AudioNode'").replace('AudioFrame', "'AudioFrame'")
-    signature = signature.replace('NoneType', 'None')
-    signature = signature.replace('str, bytes, bytearray', 'DataType')
-
-    for t in types:
-        for t_ in {t, f"'{t}'"}:
-            signature = signature.replace(f'Union[{t_}]', f'{t_}')
-            signature = signature.replace(f'Union[{t_}, None]', f'Optional[{t_}]')
-            signature = signature.replace(f'Union[{t_}, Sequence[{t_}]]', f'SingleAndSequence[{t_}]')
-            signature = signature.replace(
-                f'Union[{t_}, Sequence[{t_}], None]', f'Optional[SingleAndSequence[{t}]]'
-            )
 
-    callback_type = 'VSMapValueCallback[_VapourSynthMapValue]'
+callback_type = 'VSMapValueCallback[_VapourSynthMapValue]'
+
+quoted_types = {'VideoNode', 'VideoFrame', 'AudioNode', 'AudioFrame'}
+
+# Strips the module prefixes, quotes the node and frame types and names the data types.
+# A lone data type union is unwrapped here, so the union pass can match the sequences containing it.
+annotation_pattern = re.compile(
+    r'typing\.(?P<typing_data>Union\[str, bytes, bytearray\])?|(?P<data>Union\[str, bytes, bytearray\]|str, bytes, bytearray)'
+    r'|vapoursynth\.|vs\.|NoneType|' + '|'.join(sorted(quoted_types))
+)
+
+# Shortens the unions of the known types and the callbacks, renames parameters that are keywords
+type_pattern = '|'.join(sorted(types))
+union_pattern = re.compile(
+    fr"Union\[(?P<t>'(?:{type_pattern})'|(?:{type_pattern}))"
+    r'(?P<union>\]|, None\]|, Sequence\[(?P=t)\]\]|, Sequence\[(?P=t)\], None\])'
+    r'|Union\[Func, Callable(?P<callback>\]|, None\])'
+    fr"| (?P<kw>{'|'.join(reserved_keywords)}):"
+)
+
+
+def _clean_annotation(match: re.Match) -> str:
+    token = match.group()
+
+    if match.group('data') or match.group('typing_data'):
+        return 'DataType'
+    if token in quoted_types:
+        return f"'{token}'"
+    if token == 'NoneType':
+        return 'None'
+
+    return ''
 
-    # Make Callable definitions sensible
-    signature = signature.replace('Union[Func, Callable]', callback_type)
-    signature = signature.replace('Union[Func, Callable, None]', f'Optional[{callback_type}]')
 
-    # Replace the keywords with valid values
-    for kw in reserved_keywords:
-        signature = signature.replace(f' {kw}:', f' {kw}_:')
+def _clean_union(match: re.Match) -> str:
+    t, union, callback, kw = match.group('t', 'union', 'callback', 'kw')
 
-    return signature
+    if kw:
+        return f' {kw}_:'
+
+    if callback:
+        return callback_type if callback == ']' else f'Optional[{callback_type}]'
+
+    if union == ']':
+        return t
+    if union == ', None]':
+        return f'Optional[{t}]'
+    if union.endswith(', None]'):
+        # The sequence form always drops the quotes
+        name = t.strip("'")
+        return f'Optional[SingleAndSequence[{name}]]'
+
+    return f'SingleAndSequence[{t}]'
+
+
+def clean_signature(signature: Any) -> str:
+    # Clean up the type annotations so that they are valid python syntax.
+    signature = annotation_pattern.sub(_clean_annotation, str(signature))
+
+    return union_pattern.sub(_clean_union, signature)
 
 
 def get_complex_signature(signature: TypedDict) -> Tuple[str, str]:
@@ -238,17 +288,22 @@ class BoundSignature:
     def __init__(self, namespace: str, cores: Iterable[CoreLike]) -> None:
         self.namespace = namespace
         self.cores = cores
+        self._signatures: Optional[List[Tuple[str, List[Tuple[str, Tuple[str, str] | None]]]]] = None
 
-    def __iter__(self) -> Iterator[Tuple[str, Iterator[Tuple[str, Tuple[str, str] | None]]]]:
+    def _retrieve(self) -> Iterator[Tuple[str, List[Tuple[str, Tuple[str, str] | None]]]]:
         for core in self.cores:
-            signatures = retrieve_func_sigs(core, self.namespace)
+            signatures = list(retrieve_func_sigs(core, self.namespace))
 
-            try:
-                signature = next(signatures)
-            except StopIteration:
-                continue
+            if signatures:
+                yield core.__class__.__name__, signatures
 
-            yield core.__class__.__name__, chain.from_iterable(([signature], signatures))
+    def __iter__(self) -> Iterator[Tuple[str, Iterator[Tuple[str, Tuple[str, str] | None]]]]:
+        # Introspected once, the implementations and the instances both walk the same result
+        if self._signatures is None:
+            self._signatures = list(self._retrieve())
+
+        for core_name, signatures in self._signatures:
+            yield core_name, iter(signatures)
 
 
 class PluginMeta(NamedTuple):
@@ -413,6 +468,53 @@ def make_instances(plugins: Iterable[PluginMeta]) -> Iterator[Instance]:
             yield Instance(plugin, core_name, definition)
 
 
+worker_cores: List[CoreLike] = []
+
+
+def init_worker(args: Namespace) -> None:
+    worker_cores.extend(get_cores(load_plugins(args)))
+
+
+def make_worker_blocks(namespaces: List[str]) -> List[Tuple[str, List[str], List[Tuple[str, List[str]]]]]:
+    # Runs in a worker process, only plain text goes back to the parent
+    plugins = [PluginMeta.from_namespace(namespace, worker_cores) for namespace in namespaces]
+
+    instances = list(make_instances(plugins))
+
+    return [
+        (
+            impl.plugin.name, impl.content,
+            [(inst.core_name, inst.definition) for inst in instances if inst.plugin.name == impl.plugin.name]
+        )
+        for impl in make_implementations(plugins)
+    ]
+
+
+def make_blocks(args: Namespace, plugins: List[PluginMeta]) -> Tuple[List[Implementation], List[Instance]]:
+    if args.jobs <= 1 or len(plugins) <= 1:
+        return list(make_implementations(plugins)), list(make_instances(plugins))
+
+    by_name = {plugin.name: plugin for plugin in plugins}
+    names = sorted(by_name)
+
+    # More shards than workers, so one slow plugin doesn't hold up the others
+    shards = [names[i::args.jobs * 4] for i in range(min(len(names), args.jobs * 4))]
+
+    implementations: List[Implementation] = []
+    instances: List[Instance] = []
+
+    # Spawned, a forked worker would inherit this core with the plugins already loaded
+    with ProcessPoolExecutor(
+        args.jobs, mp_context=multiprocessing.get_context('spawn'), initializer=init_worker, initargs=(args,)
+    ) as executor:
+        for blocks in executor.map(make_worker_blocks, shards):
+            for name, content, definitions in blocks:
+                implementations.append(Implementation(by_name[name], content))
+                instances.extend(Instance(by_name[name], core_name, definition) for core_name, definition in definitions)
+
+    return implementations, instances
+
+
 def locate_or_create_stub_file() -> str:
     site_package_dir = path.dirname(vs.__file__)
     stub_dir = join_path(site_package_dir, site_package_dirname)
@@ -444,36 +546,107 @@ def locate_or_create_stub_file() -> str:
     return output_path
 
 
+class StubIndex(NamedTuple):
+    path: Path
+    implementations: Dict[str, Tuple[int, int]]
+    instances: Dict[str, Dict[str, Tuple[int, int]]]
+
+
+def index_existing_stubs(path: Path) -> StubIndex:
+    # Byte ranges of every plugin block, from its start marker line through its end marker line
+    implementations: Dict[str, Tuple[int, int]] = {}
+    instances: Dict[str, Dict[str, Tuple[int, int]]] = {}
+
+    impl_start, impl_end = implementation_start.encode(), implementation_end.encode()
+    inst_start, inst_end = instance_start.encode(), instance_end.encode()
+
+    with open(path, 'rb') as f:
+        offset = 0
+        block_start = 0
+        plugin_name: Optional[str] = None
+        core_name: Optional[str] = None
+
+        for orig_line in f:
+            line = orig_line.strip()
+
+            if line.startswith(impl_start):
+                plugin_name, core_name = line[len(impl_start) + 1:].decode().strip(), None
+                block_start = offset
+            elif line.startswith(inst_start):
+                core_name, plugin_name = instance_bound_pattern.findall(line.decode())[0]
+                block_start = offset
+
+            offset += len(orig_line)
+
+            if plugin_name and core_name is None and line.startswith(impl_end):
+                implementations[plugin_name] = (block_start, offset)
+                plugin_name = None
+            elif plugin_name and core_name is not None and line.startswith(inst_end):
+                instances.setdefault(core_name, {})[plugin_name] = (block_start, offset)
+                plugin_name = None
+
+    return StubIndex(path, implementations, instances)
+
+
+def read_block(f: BinaryIO, block: Tuple[int, int]) -> List[str]:
+    f.seek(block[0])
+
+    return f.read(block[1] - block[0]).decode(getpreferredencoding(False)).splitlines()
+
+
+def get_existing_implementations(index: StubIndex, names: Iterable[str]) -> Dict[str, Implementation]:
+    result: Dict[str, Implementation] = {}
+
+    with open(index.path, 'rb') as f:
+        for name in names:
+            if name in index.implementations:
+                # Copied verbatim, padded like a generated block. The plugin is never resolved on the core.
+                result[name] = Implementation(
+                    PluginMeta(name, '', BoundSignature(name, [])),
+                    ['', '\n'.join(read_block(f, index.implementations[name])), '']
+                )
+
+    return result
+
+
+def get_existing_instances(index: StubIndex, names: Iterable[str]) -> Dict[str, Dict[str, Instance]]:
+    result: Dict[str, Dict[str, Instance]] = {}
+
+    with open(index.path, 'rb') as f:
+        for name in names:
+            for core_name, blocks in index.instances.items():
+                if name in blocks:
+                    result.setdefault(core_name, {})[name] = Instance(
+                        PluginMeta(name, '', BoundSignature(name, [])), core_name,
+                        [line[4:] for line in read_block(f, blocks[name])]
+                    )
+
+    return result
+
+
+include_pattern = re.compile(r'#include <([^>]+)>')
+bound_include_prefix = 'plugins/bound/'
+
+
 def generate_template(
     args: Namespace, cores: Sequence[CoreLike],
     implementations: List[Implementation], instances: List[Instance],
-    existing_stubs: Union[Path, None] = None
-) -> str:
-    template = Path(args.pyi_template).read_text()
+    existing_stubs: Union[StubIndex, None] = None
+) -> Iterator[str]:
+    # Alternating literal text and the names of the includes between them
+    segments = include_pattern.split(Path(args.pyi_template).read_text())
 
     if args.plugins and existing_stubs:
-        existing_implementations = get_existing_implementations(existing_stubs, cores)
-        existing_instances = get_existing_instances(existing_stubs, cores)
-
         selected_implementations = [impl.plugin.name for impl in implementations]
-        selected_instances = [inst.core_name for inst in instances]
 
-        missing_impl = {*existing_implementations} - {*selected_implementations}
+        missing_impl = {*existing_stubs.implementations} - {*selected_implementations}
 
-        total_core_names = {*existing_instances, *selected_instances}
-
-        implementations.extend([
-            existing_implementations[name] for name in missing_impl
-        ])
+        implementations.extend(get_existing_implementations(existing_stubs, missing_impl).values())
 
         instances.extend([
-            impl[inst_name]
-            for impl in [
-                existing_instances[core_name] for core_name in total_core_names
-                if core_name in existing_instances
-            ]
-            for inst_name in missing_impl
-            if inst_name in impl
+            inst
+            for core_instances in get_existing_instances(existing_stubs, missing_impl).values()
+            for inst in core_instances.values()
         ])
 
     if args.exclude_plugin and existing_stubs:
@@ -483,25 +656,187 @@ def generate_template(
     implementations = sorted(implementations)
     instances = sorted(instances)
 
-    implementation_inject = indent('\n'.join(x.content) for x in implementations)
+    core_names = {core.__class__.__name__ for core in cores}
+
+    for i, segment in enumerate(segments):
+        if i % 2 == 0:
+            yield segment
+        elif segment == 'plugins/implementations':
+            for j, impl in enumerate(implementations):
+                yield ('\n' if j else '') + indent(['\n'.join(impl.content)])
+        elif segment.startswith(bound_include_prefix) and segment[len(bound_include_prefix):] in core_names:
+            this_core_name = segment[len(bound_include_prefix):]
+
+            for j, definition in enumerate(
+                definition for _, core_name, definition in instances if core_name == this_core_name
+            ):
+                yield ('\n' if j else '') + indent(definition)
+        else:
+            yield f'#include <{segment}>'
 
-    template = template.replace('#include <plugins/implementations>', implementation_inject)
 
-    for core in cores:
-        this_core_name = core.__class__.__name__
+manifest_suffix = '.manifest.json'
+
+
+def get_plugin_fingerprint(core: vs.Core, namespace: str) -> Dict[str, Any]:
+    plugin = cast(vs.Plugin, getattr(core, namespace))
+
+    fingerprint: Dict[str, Any] = {
+        'identifier': plugin.identifier, 'version': str(getattr(plugin, 'version', ''))
+    }
+
+    plugin_path = getattr(plugin, 'plugin_path', None)
+
+    if plugin_path:
+        try:
+            plugin_stat = stat(plugin_path)
+        except OSError:
+            pass
+        else:
+            fingerprint |= {'path': plugin_path, 'size': plugin_stat.st_size, 'mtime_ns': plugin_stat.st_mtime_ns}
+
+    return fingerprint
+
+
+def get_template_hash(args: Namespace) -> str:
+    # A different template or generator invalidates every recorded block
+    template_hash = sha256(Path(args.pyi_template).read_bytes())
+    template_hash.update(Path(__file__).read_bytes())
+
+    return template_hash.hexdigest()
+
+
+def get_block_hashes(implementations: List[Implementation], instances: List[Instance]) -> Dict[str, str]:
+    # Hashes what each plugin contributes to the stubs, ignoring indentation and blank lines
+    definitions: Dict[str, List[Tuple[str, List[str]]]] = {}
+
+    for inst in instances:
+        definitions.setdefault(inst.plugin.name, []).append((inst.core_name, inst.definition))
+
+    result: Dict[str, str] = {}
+
+    for impl in implementations:
+        # Generated content has multi-line entries, the parsed one has a line per entry
+        lines = '\n'.join(chain(
+            impl.content, *(definition for _, definition in sorted(definitions.get(impl.plugin.name, [])))
+        )).splitlines()
+
+        result[impl.plugin.name] = sha256(
+            '\n'.join(line.strip() for line in lines if line.strip()).encode()
+        ).hexdigest()
+
+    return result
+
+
+def load_manifest(manifest_path: Path) -> Dict[str, Any]:
+    try:
+        return cast(Dict[str, Any], json.loads(manifest_path.read_text()))
+    except (OSError, ValueError):
+        return {}
+
+
+def get_reusable_blocks(
+    args: Namespace, cores: Sequence[CoreLike], plugins: List[PluginMeta],
+    existing_stubs: StubIndex, manifest: Dict[str, Any]
+) -> Tuple[List[Implementation], List[Instance]]:
+    # Blocks of the existing stubs whose plugin binary and content are unchanged since they were generated
+    if args.plugins or args.exclude_plugin or args.force or manifest.get('template') != get_template_hash(args):
+        return [], []
+
+    recorded = manifest.get('plugins', {})
+
+    candidates = {
+        plugin.name for plugin in plugins
+        if plugin.name in existing_stubs.implementations and plugin.name in recorded
+        and recorded[plugin.name]['fingerprint'] == get_plugin_fingerprint(cast(vs.Core, cores[0]), plugin.name)
+    }
+
+    implementations = list(get_existing_implementations(existing_stubs, candidates).values())
+    instances = [
+        inst for core_instances in get_existing_instances(existing_stubs, candidates).values()
+        for inst in core_instances.values()
+    ]
+
+    block_hashes = get_block_hashes(implementations, instances)
+
+    unchanged = {name for name, block_hash in block_hashes.items() if recorded[name]['hash'] == block_hash}
+
+    return (
+        [impl for impl in implementations if impl.plugin.name in unchanged],
+        [inst for inst in instances if inst.plugin.name in unchanged]
+    )
+
+
+def write_manifest(
+    args: Namespace, cores: Sequence[CoreLike], manifest_path: Path, manifest: Dict[str, Any],
+    generated: Iterable[str], implementations: List[Implementation], instances: List[Instance]
+) -> None:
+    template_hash = get_template_hash(args)
+
+    # Blocks kept from the existing stubs keep their recorded fingerprint, if it still applies
+    recorded = manifest.get('plugins', {}) if manifest.get('template') == template_hash else {}
+
+    plugins: Dict[str, Any] = {}
+
+    for name, block_hash in get_block_hashes(implementations, instances).items():
+        if name in generated:
+            plugins[name] = {'fingerprint': get_plugin_fingerprint(cast(vs.Core, cores[0]), name), 'hash': block_hash}
+        elif name in recorded:
+            plugins[name] = recorded[name]
+
+    manifest_path.write_text(json.dumps({'template': template_hash, 'plugins': plugins}, indent=1, sort_keys=True))
+
+
+function_pattern = re.compile(r'\s*def (\w+)\((?:self, |self)(.*): \.\.\.$')
 
-        this_core_template = '\n'.join(
-            indent(definition) for _, core_name, definition in instances if core_name == this_core_name
-        )
 
-        template = template.replace(f'#include <plugins/bound/{this_core_name}>', this_core_template)
+def get_capabilities_path(args: Namespace) -> Optional[str]:
+    if args.capabilities == '@':
+        return default_capabilities_path()
 
-    return template
+    return cast(Optional[str], args.capabilities or None)
 
 
-def output_stubs(
-    args: Namespace, cores: Sequence[CoreLike], implementations: List[Implementation], instances: List[Instance]
+def write_capabilities(
+    args: Namespace, cores: Sequence[CoreLike], plugins: List[PluginMeta], implementations: List[Implementation]
 ) -> None:
+    # The namespaces, functions and signatures of the loaded plugins, for tools that can't wait for a core
+    capabilities_path = get_capabilities_path(args)
+
+    if capabilities_path is None:
+        return
+
+    contents = {impl.plugin.name: impl.content for impl in implementations}
+
+    # A partial run only knows about the selected plugins
+    cached = dict(load_capabilities(capabilities_path).plugins) if args.plugins else {}
+
+    for plugin in plugins:
+        if plugin.name not in contents:
+            continue
+
+        functions: Dict[str, str] = {}
+
+        for line in '\n'.join(contents[plugin.name]).splitlines():
+            match = function_pattern.match(line)
+
+            if match and match.group(1) not in functions:
+                functions[match.group(1)] = '(' + match.group(2)
+
+        vs_plugin = cast(vs.Plugin, getattr(cores[0], plugin.name))
+
+        cached[plugin.name] = {
+            'identifier': vs_plugin.identifier, 'name': plugin.description,
+            'path': getattr(vs_plugin, 'plugin_path', None), 'functions': functions
+        }
+
+    makedirs(path.dirname(path.abspath(capabilities_path)), exist_ok=True)
+
+    with open(capabilities_path, 'w') as f:
+        json.dump({'version': capabilities_version, 'plugins': cached}, f, sort_keys=True)
+
+
+def output_stubs(args: Namespace, cores: Sequence[CoreLike], plugins: List[PluginMeta]) -> None:
     existing_stubs: Union[Path, None] = None
 
     stubs_path = str(args.output)
@@ -523,75 +858,67 @@ def output_stubs(
             else:
                 stubs /= 'vapoursynth.pyi'
 
-        existing_stubs = stubs if stubs.exists() and stubs.is_file() else None
-
-        if existing_stubs and args.force:
-            existing_stubs.unlink(True)
-            existing_stubs.touch()
-        else:
-            makedirs(stubs.parent, exist_ok=True)
-
-    template = generate_template(args, cores, implementations, instances, existing_stubs)
-
-    out_file = sys.stdout if stubs_path == '-' else open(str(stubs), 'w')
-
-    with out_file:
-        out_file.write(template)
-        out_file.flush()
-
+        # Forced runs ignore the existing stubs, the replace at the end still overwrites them
+        existing_stubs = stubs if stubs.exists() and stubs.is_file() and not args.force else None
 
-def get_existing_implementations(path: Union[str, Path], cores: Sequence[CoreLike]) -> Dict[str, Implementation]:
-    result: Dict[str, Implementation] = {}
+        makedirs(stubs.parent, exist_ok=True)
 
-    with open(path, "r") as f:
-        plugin_name: Optional[str] = None
+    manifest_path = stubs.with_name(stubs.name + manifest_suffix)
+    manifest = load_manifest(manifest_path) if stubs_path != '-' else {}
 
-        for orig_line in f:
-            line = orig_line.strip()
+    stub_index = index_existing_stubs(existing_stubs) if existing_stubs else None
 
-            if line.startswith(implementation_start):
-                plugin_name = line[len(implementation_start) + 1:].strip()
-                result[plugin_name] = Implementation.from_namespace(plugin_name, cores)
+    reused_implementations: List[Implementation] = []
+    reused_instances: List[Instance] = []
 
-            if plugin_name:
-                result[plugin_name].content.append(orig_line.rstrip())
+    if stub_index and manifest:
+        reused_implementations, reused_instances = get_reusable_blocks(
+            args, cores, plugins, stub_index, manifest
+        )
 
-            if line.startswith(implementation_end):
-                plugin_name = None
+    reused = {impl.plugin.name for impl in reused_implementations}
 
-    return result
+    # Only these get introspected
+    generate = [plugin for plugin in plugins if plugin.name not in reused]
 
+    capabilities_path = get_capabilities_path(args)
 
-def get_existing_instances(path: Union[str, Path], cores: Sequence[CoreLike]) -> Dict[str, Dict[str, Instance]]:
-    result: Dict[str, Dict[str, Instance]] = {}
+    # Nothing to do unless a plugin also disappeared
+    if (
+        stub_index and reused and not generate and reused == {*stub_index.implementations}
+        and (capabilities_path is None or path.exists(capabilities_path))
+    ):
+        return
 
-    with open(path, "r") as f:
-        core_name: str = ''
-        plugin_name: Optional[str] = None
+    implementations, instances = make_blocks(args, generate)
 
-        for orig_line in f:
-            line = orig_line.strip()
+    implementations += reused_implementations
+    instances += reused_instances
 
-            if line.startswith(instance_start):
-                core_name, plugin_name = instance_bound_pattern.findall(line)[0]
+    template = generate_template(args, cores, implementations, instances, stub_index)
 
-                assert plugin_name
-
-                if core_name not in result:
-                    result[core_name] = {}
+    if stubs_path == '-':
+        sys.stdout.writelines(template)
+        sys.stdout.flush()
+    else:
+        # Written next to the stubs and swapped in, a failed run leaves the old file intact
+        tmp_stubs = stubs.with_name(stubs.name + '.tmp')
 
-                if plugin_name not in result[core_name]:
-                    result[core_name][plugin_name] = Instance.from_namespace(
-                        plugin_name, core_name, cores
-                    )
+        try:
+            with open(tmp_stubs, 'w') as out_file:
+                out_file.writelines(template)
+        except BaseException:
+            tmp_stubs.unlink(missing_ok=True)
+            raise
 
-            if plugin_name:
-                result[core_name][plugin_name].definition.append(orig_line.rstrip()[4:])
+        replace(tmp_stubs, stubs)
 
-            if line.startswith(instance_end):
-                plugin_name = None
+    if stubs_path != '-':
+        write_manifest(
+            args, cores, manifest_path, manifest, {plugin.name for plugin in generate}, implementations, instances
+        )
 
-    return result
+        write_capabilities(args, cores, plugins, implementations)
 
 
 def main(argv: List[str] = sys.argv[1:]):
@@ -599,14 +926,11 @@ def main(argv: List[str] = sys.argv[1:]):
 
     core = load_plugins(args)
 
-    cores: List[CoreLike] = [core, core.std.BlankClip(), core.std.BlankAudio()]
+    cores = get_cores(core)
 
     signatures = list(retrieve_plugins(args, core, cores))
 
-    implementations = make_implementations(signatures)
-    instances = make_instances(signatures)
-
-    output_stubs(args, cores, list(implementations), list(instances))
+    output_stubs(args, cores, signatures)
 
 
 if __name__ == '__main__':
@@ -21,8 +21,10 @@
 ##    SOFTWARE.
 
 import argparse
+import atexit
 import base64
 import binascii
+import concurrent.futures
 import csv
 import email.utils
 import glob
@@ -32,13 +34,16 @@ import io
 import json
 import os
 import os.path
+import pickle
 import re
+import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import urllib.request
 import zipfile
-from typing import Iterator, List, MutableMapping, Optional, Tuple
+from typing import Any, Iterator, List, MutableMapping, Optional, Tuple
 
 try:
     import winreg
@@ -136,7 +141,7 @@ def get_vs_installation_site() -> str:
 is_64bits: bool = sys.maxsize > 2**32
 
 parser = argparse.ArgumentParser(description='A simple VapourSynth package manager')
-parser.add_argument('operation', choices=['install', 'update', 'upgrade', 'upgrade-all', 'uninstall', 'installed', 'available', 'paths', "genstubs", "gendistinfo"])
+parser.add_argument('operation', choices=['install', 'update', 'upgrade', 'upgrade-all', 'uninstall', 'installed', 'available', 'paths', "genstubs", "gendistinfo", "prefetch", "lock", "sync"])
 parser.add_argument('package', nargs='*', help='identifier, namespace or module to install, upgrade or uninstall')
 parser.add_argument('-f', action='store_true', dest='force', help='force upgrade for packages where the current version is unknown')
 parser.add_argument('-p', action='store_true', dest='portable', help='use paths suitable for portable installs')
@@ -144,6 +149,15 @@ parser.add_argument('-d', action='store_true', dest='skip_deps', help='skip inst
 parser.add_argument('-t', choices=['win32', 'win64'], default='win64' if is_64bits else 'win32', dest='target', help='binaries to install, defaults to python\'s architecture')
 parser.add_argument('-b', dest='binary_path', help='custom binary install path')
 parser.add_argument('-s', dest='script_path', help='custom script install path')
+parser.add_argument('-j', type=int, default=4, dest='jobs', help='number of concurrent downloads, defaults to 4')
+parser.add_argument('--cache-dir', dest='cache_dir', help='custom download cache path')
+parser.add_argument('--cache-size', type=int, default=2048, dest='cache_size', help='download cache size limit in MiB, defaults to 2048')
+parser.add_argument('--offline', action='store_true', dest='offline', help='only install packages already in the download cache')
+parser.add_argument('--verify', action='store_true', dest='verify', help='rehash all installed files instead of trusting the manifest')
+parser.add_argument('--lockfile', default='vsrepo-lock.json', dest='lockfile', help='lockfile written by lock and applied by sync, defaults to vsrepo-lock.json')
+parser.add_argument('--prune', action='store_true', dest='prune', help='make sync also uninstall packages missing from the lockfile')
+parser.add_argument('--defer-stubs', action='store_true', dest='defer_stubs', help='don\'t update the VapourSynth stubs, run genstubs later')
+parser.add_argument('--dry-run', action='store_true', dest='dry_run', help='only print what install, upgrade and sync would do and how much they would download')
 args = parser.parse_args()
 
 is_64bits = args.target == 'win64'
@@ -210,51 +224,334 @@ if not os.path.isfile(cmd7zip_path):
     except:
         cmd7zip_path = '7z.exe'
 
+cache_path: str = args.cache_dir if args.cache_dir is not None else os.path.join(os.path.dirname(package_json_path), 'vsrepo-cache')
+os.makedirs(cache_path, exist_ok=True)
+
 installed_packages: MutableMapping = {}
+changed_stub_namespaces: set = set()
+removed_stub_namespaces: set = set()
 download_cache: MutableMapping = {}
-
-def fetch_ur1(url: str, desc: Optional[str] = None) -> bytearray:
-    with urllib.request.urlopen(url) as urlreq:
-        if ('tqdm' in sys.modules) and (urlreq.headers['content-length'] is not None):
-            size = int(urlreq.headers['content-length'])
-            remaining = size
-            data = bytearray()
-            with tqdm.tqdm(total=size, unit='B', unit_scale=True, unit_divisor=1024, desc=desc) as t:
-                while remaining > 0:
-                    blocksize = min(remaining, 1024*128)
-                    data.extend(urlreq.read(blocksize))
-                    remaining = remaining - blocksize
-                    t.update(blocksize)
-            return data
+temp_downloads: List[str] = []
+# Archives without a hash of their own, staged until extraction has verified their files
+unverified_downloads: MutableMapping = {}
+# url -> lock, packages sharing an archive extract it one at a time
+archive_locks: MutableMapping = {}
+progress_lock = threading.Lock()
+
+def fetch_ur1(url: str, desc: Optional[str] = None, progress: Optional[Any] = None, dir: Optional[str] = None) -> Tuple[str, str]:
+    # Streams the download to a temporary file and hashes it on the way, returns the path and its sha256
+    tffd, tfpath = tempfile.mkstemp(prefix='vsm', dir=dir)
+    data_hash = hashlib.sha256()
+    try:
+        with open(tffd, mode='wb') as tf, urllib.request.urlopen(url) as urlreq:
+            size = urlreq.headers['content-length']
+            own_progress = None
+            if progress is not None:
+                # Shared progress bar, the total grows as each download reports its size
+                if size is not None:
+                    with progress_lock:
+                        progress.total += int(size)
+                        progress.refresh()
+            elif ('tqdm' in sys.modules) and (size is not None):
+                progress = own_progress = tqdm.tqdm(total=int(size), unit='B', unit_scale=True, unit_divisor=1024, desc=desc)
+            else:
+                print('Fetching: ' + url)
+            try:
+                while True:
+                    block = urlreq.read(1024*128)
+                    if not block:
+                        break
+                    tf.write(block)
+                    data_hash.update(block)
+                    if progress is not None:
+                        with progress_lock:
+                            progress.update(len(block))
+            finally:
+                if own_progress is not None:
+                    own_progress.close()
+    except BaseException:
+        os.remove(tfpath)
+        raise
+    return (tfpath, data_hash.hexdigest())
+
+def get_release_cache_key(p: MutableMapping, rel: MutableMapping) -> Tuple[str, Optional[str]]:
+    # Returns the cache file name and the sha256 the download must have, if it is known
+    bin_name = get_bin_name(p)
+    if 'hash' in rel[bin_name]:
+        return (rel[bin_name]['hash'], rel[bin_name]['hash'])
+    files = rel[bin_name]['files']
+    if len(files) == 1:
+        for fn_props in files.values():
+            if fn_props[0] == rel[bin_name]['url'].rsplit('/', 2)[-1]:
+                return (fn_props[1], fn_props[1])
+    # Archives have no hash of their own, name them after the files they contain
+    files_hash = hashlib.sha256('\n'.join(sorted(fn_props[1] for fn_props in files.values())).encode('ascii')).hexdigest()
+    return ('files-' + files_hash, None)
+
+def fetch_release(p: MutableMapping, rel: MutableMapping, progress: Optional[Any] = None) -> Tuple[str, str]:
+    url = rel[get_bin_name(p)]['url']
+    download = download_cache.get(url, None)
+    if download is not None:
+        return download
+
+    key, expected_hash = get_release_cache_key(p, rel)
+    cached_fn = os.path.join(cache_path, key)
+    if os.path.isfile(cached_fn):
+        cached_hash = hash_file(cached_fn)
+        if expected_hash is None or cached_hash == expected_hash:
+            # Touch it so eviction treats it as recently used
+            os.utime(cached_fn)
+            download = (cached_fn, cached_hash)
+        else:
+            # Changed since it was cached, fetch it again
+            print('Cached download of ' + p['name'] + ' ' + rel['version'] + ' is corrupt, discarding it')
+            os.remove(cached_fn)
+    if download is None and args.offline:
+        raise Exception(p['name'] + ' ' + rel['version'] + ' is not in the download cache')
+    if download is None:
+        tfpath, data_hash = fetch_ur1(url, p['name'] + ' ' + rel['version'], progress, cache_path)
+        if expected_hash == data_hash:
+            os.replace(tfpath, cached_fn)
+            download = (cached_fn, data_hash)
+        elif expected_hash is None:
+            # Only cached by cache_verified_download, a broken archive would fail every later install
+            temp_downloads.append(tfpath)
+            unverified_downloads[tfpath] = (url, cached_fn)
+            download = (tfpath, data_hash)
         else:
-            print('Fetching: ' + url)
-            return urlreq.read()
+            # Keep it out of the cache, the install reports the mismatch
+            temp_downloads.append(tfpath)
+            download = (tfpath, data_hash)
+    download_cache[url] = download
+    return download
+
+def cache_verified_download(archive_path: str) -> None:
+    # Moves a staged archive into the cache once all its files checked out
+    staged = unverified_downloads.pop(archive_path, None)
+    if staged is None:
+        return
+    url, cached_fn = staged
+    os.replace(archive_path, cached_fn)
+    temp_downloads.remove(archive_path)
+    download_cache[url] = (cached_fn, download_cache[url][1])
+
+def discard_download(url: str, archive_path: str) -> None:
+    # A cached archive whose files failed to verify, later installs download it again
+    if download_cache.get(url, (None,))[0] == archive_path:
+        del download_cache[url]
+    if archive_path not in unverified_downloads and archive_path not in temp_downloads:
+        try:
+            os.remove(archive_path)
+        except OSError:
+            pass
 
-def fetch_url_cached(url: str, desc: str = "") -> bytearray:
-    data = download_cache.get(url, None)
-    if data is None:
-        data = fetch_ur1(url, desc)
-        download_cache[url] = data
-    return data
+@atexit.register
+def remove_downloads() -> None:
+    for tfpath in temp_downloads:
+        try:
+            os.remove(tfpath)
+        except OSError:
+            pass
+
+@atexit.register
+def evict_download_cache() -> None:
+    # Drop the least recently used archives until the cache fits, never the ones used by this run
+    in_use = {os.path.normcase(os.path.abspath(download[0])) for download in download_cache.values()}
+    entries = []
+    total_size = 0
+    try:
+        for entry in os.scandir(cache_path):
+            if entry.is_file() and not entry.name.startswith('vsm'):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total_size += st.st_size
+    except OSError:
+        return
+    entries.sort()
+    for _, size, fn in entries:
+        if total_size <= args.cache_size * 1024 * 1024:
+            break
+        if os.path.normcase(os.path.abspath(fn)) in in_use:
+            continue
+        try:
+            os.remove(fn)
+            total_size -= size
+        except OSError:
+            pass
 
 package_print_string = "{:25s} {:15s} {:11s} {:11s} {:s}"
 
 package_list: Optional[MutableMapping] = None
-try:
-    with open(package_json_path, 'r', encoding='utf-8') as pl:
-        package_list = json.load(pl)
+
+# Preprocessed copy of vspackages3.json, rebuilt whenever the json changes
+package_store_path = os.path.splitext(package_json_path)[0] + '.pickle'
+package_store_version = 1
+# (identifier, bin name, max api) -> index of the latest installable release, -1 if there is none
+latest_installable: MutableMapping = {}
+
+# Lookup tables built once from package_list, the first package wins like the old linear scans did
+packages_by_id: MutableMapping = {}
+packages_by_namespace: MutableMapping = {}
+packages_by_modulename: MutableMapping = {}
+packages_by_name: MutableMapping = {}
+
+def index_packages() -> None:
+    for index in (packages_by_id, packages_by_namespace, packages_by_modulename, packages_by_name):
+        index.clear()
     if package_list is None:
-        raise ValueError()
-    if package_list['file-format'] != 3:
-        print('Package definition format is {} but only version 3 is supported'.format(package_list['file-format']))
-        raise ValueError()
-    package_list = package_list.get('packages')
-except (OSError, FileExistsError, ValueError):
+        return
+    for p in package_list:
+        packages_by_id.setdefault(p['identifier'], p)
+        if 'namespace' in p:
+            packages_by_namespace.setdefault(p['namespace'], p)
+        if 'modulename' in p:
+            packages_by_modulename.setdefault(p['modulename'], p)
+        packages_by_name.setdefault(p['name'].casefold(), p)
+
+def get_package_bin_names(p: MutableMapping) -> List[str]:
+    if p['type'] == 'PyScript':
+        return ['script']
+    if p['type'] == 'PyWheel':
+        return ['wheel']
+    elif p['type'] == 'VSPlugin':
+        return ['win32', 'win64']
+    else:
+        return []
+
+def find_latest_installable_release(p: MutableMapping, bin_name: str, max_api: int) -> int:
+    package_api: int = 3
+    if 'api' in p:
+        package_api = int(p['api'])
+    for idx, rel in enumerate(p['releases']):
+        if not isinstance(rel, MutableMapping):
+            continue
+        if bin_name in rel:
+            bin_api: int = package_api
+            if 'api' in rel[bin_name]:
+                bin_api = int(rel[bin_name]['api'])
+            if bin_api <= max_api and bin_api >= 3:
+                return idx
+    return -1
+
+def get_package_json_stamp() -> Tuple[int, int]:
+    st = os.stat(package_json_path)
+    return (st.st_size, st.st_mtime_ns)
+
+def write_package_store() -> None:
+    latest: MutableMapping = {}
+    for p in package_list or []:
+        for bin_name in get_package_bin_names(p):
+            for max_api in (3, 4):
+                latest[(p['identifier'], bin_name, max_api)] = find_latest_installable_release(p, bin_name, max_api)
+    latest_installable.update(latest)
+
+    store = {'version': package_store_version, 'source': get_package_json_stamp(), 'packages': package_list, 'latest': latest}
+    try:
+        with open(package_store_path + '.tmp', 'wb') as ps:
+            pickle.dump(store, ps, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(package_store_path + '.tmp', package_store_path)
+    except OSError:
+        pass
+
+def load_package_list() -> None:
+    global package_list
+    package_list = None
+    latest_installable.clear()
+    try:
+        stamp = get_package_json_stamp()
+    except OSError:
+        return
+
+    try:
+        with open(package_store_path, 'rb') as ps:
+            store = pickle.load(ps)
+        if store['version'] == package_store_version and store['source'] == stamp:
+            package_list = store['packages']
+            latest_installable.update(store['latest'])
+            index_packages()
+            return
+    except Exception:
+        pass
+
+    try:
+        with open(package_json_path, 'r', encoding='utf-8') as pl:
+            package_list = json.load(pl)
+        if package_list is None:
+            raise ValueError()
+        if package_list['file-format'] != 3:
+            print('Package definition format is {} but only version 3 is supported'.format(package_list['file-format']))
+            raise ValueError()
+        package_list = package_list.get('packages')
+    except (OSError, FileExistsError, ValueError):
+        package_list = None
+        return
+
+    write_package_store()
+    index_packages()
+
+# Only commands that look at packages pay for loading them
+if args.operation not in ('update', 'paths'):
+    load_package_list()
+
+def hash_file(path: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1024*1024), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+# Size, mtime and hash of every file vsrepo installed or hashed, so unchanged files are never read twice
+manifest_path: str = os.path.join(os.path.dirname(package_json_path), 'vsrepo-manifest.json')
+manifest: MutableMapping = {'files': {}, 'packages': {}}
+manifest_dirty = False
+verified_files: set = set()
+
+try:
+    with open(manifest_path, 'r', encoding='utf-8') as mf:
+        manifest = json.load(mf)
+except (OSError, ValueError):
     pass
 
-def check_hash(data: bytes, ref_hash: str) -> Tuple[bool, str, str]:
-    data_hash = hashlib.sha256(data).hexdigest()
-    return (data_hash == ref_hash, data_hash, ref_hash)
+def get_manifest_key(path: str) -> str:
+    return os.path.normcase(os.path.abspath(path))
+
+def hash_installed_file(path: str) -> str:
+    global manifest_dirty
+    st = os.stat(path)
+    key = get_manifest_key(path)
+    entry = manifest['files'].get(key)
+    # With --verify every file is hashed again, but only once per run
+    if (not args.verify or key in verified_files) and entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+        return entry[2]
+    file_hash = hash_file(path)
+    verified_files.add(key)
+    manifest['files'][key] = [st.st_size, st.st_mtime_ns, file_hash]
+    manifest_dirty = True
+    return file_hash
+
+def record_installed_files(p: MutableMapping, version: str, files: List[Tuple[str, str, str]]) -> None:
+    global manifest_dirty
+    for filename, sha256hex, _ in files:
+        st = os.stat(filename)
+        manifest['files'][get_manifest_key(filename)] = [st.st_size, st.st_mtime_ns, sha256hex]
+    manifest['packages'][p['identifier']] = version
+    manifest_dirty = True
+
+def forget_installed_files(p: MutableMapping, filenames: List[str]) -> None:
+    global manifest_dirty
+    for filename in filenames:
+        manifest['files'].pop(get_manifest_key(filename), None)
+    manifest['packages'].pop(p['identifier'], None)
+    manifest_dirty = True
+
+@atexit.register
+def save_manifest() -> None:
+    if not manifest_dirty:
+        return
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as mf:
+        json.dump(manifest, mf)
+    os.replace(tmp_path, manifest_path)
 
 def get_bin_name(p: MutableMapping):
     if p['type'] == 'PyScript':
@@ -280,44 +577,34 @@ def get_install_path(p: MutableMapping) -> str:
 def get_package_from_id(id: str, required: bool = False) -> Optional[MutableMapping]:
     if package_list is None:
         return None
-    for p in package_list:
-        if p['identifier'] == id:
-            return p
-    if required:
+    p = packages_by_id.get(id)
+    if p is None and required:
         raise ValueError(f'No package with the identifier {id} found')
-    return None
+    return p
 
 def get_package_from_plugin_name(name: str, required: bool = False) -> Optional[MutableMapping]:
     if package_list is None:
         return None
-    for p in package_list:
-        if p['name'].casefold() == name.casefold():
-            return p
-    if required:
+    p = packages_by_name.get(name.casefold())
+    if p is None and required:
         raise ValueError(f'No package with the name {name} found')
-    return None
+    return p
 
 def get_package_from_namespace(namespace: str, required: bool = False) -> Optional[MutableMapping]:
     if package_list is None:
         return None
-    for p in package_list:
-        if 'namespace' in p:
-            if p['namespace'] == namespace:
-                return p
-    if required:
+    p = packages_by_namespace.get(namespace)
+    if p is None and required:
         raise ValueError(f'No package with the namespace {namespace} found')
-    return None
+    return p
 
 def get_package_from_modulename(modulename: str, required: bool = False) -> Optional[MutableMapping]:
     if package_list is None:
         return None
-    for p in package_list:
-        if 'modulename' in p:
-            if p['modulename'] == modulename:
-                return p
-    if required:
+    p = packages_by_modulename.get(modulename)
+    if p is None and required:
         raise ValueError(f'No package with the modulename {modulename} found')
-    return None
+    return p
 
 def get_package_from_name(name: str) -> MutableMapping:
     p = get_package_from_id(name)
@@ -375,21 +662,25 @@ def detect_installed_packages() -> None:
                 if version is not None:
                     installed_packages[p['identifier']] = version
             else:
-                for v in p['releases']:
+                # Try the version recorded at install time first, then every release
+                recorded_version = manifest['packages'].get(p['identifier'])
+                releases = sorted(p['releases'], key=lambda rel: rel['version'] != recorded_version)
+                for v in releases:
                     matched = True
                     exists = True
                     bin_name = get_bin_name(p)
                     if bin_name in v:
                         for f in v[bin_name]['files']:
                             try:
-                                with open(os.path.join(dest_path, f), 'rb') as fh:
-                                    if not check_hash(fh.read(), v[bin_name]['files'][f][1])[0]:
-                                        matched = False
+                                if hash_installed_file(os.path.join(dest_path, f)) != v[bin_name]['files'][f][1]:
+                                    matched = False
                             except FileNotFoundError:
                                 exists = False
                                 matched = False
                         if matched:
                             installed_packages[p['identifier']] = v['version']
+                            if recorded_version != v['version']:
+                                manifest['packages'][p['identifier']] = v['version']
                             break
                         elif exists:
                             installed_packages[p['identifier']] = 'Unknown'
@@ -423,20 +714,15 @@ def list_available_packages() -> None:
 
 def get_latest_installable_release_with_index(p: MutableMapping) -> Tuple[int, Optional[MutableMapping]]:
     max_api = get_vapoursynth_api_version()
-    package_api: int = 3
-    if 'api' in p:
-        package_api = int(p['api'])
     bin_name = get_bin_name(p)
-    for idx, rel in enumerate(p['releases']):
-        if not isinstance(rel, MutableMapping):
-            continue
-        if bin_name in rel:
-            bin_api: int = package_api
-            if 'api' in rel[bin_name]:
-                bin_api = int(rel[bin_name]['api'])
-            if bin_api <= max_api and bin_api >= 3:
-                return (idx, rel)
-    return (-1, None)
+    key = (p['identifier'], bin_name, max_api)
+    idx = latest_installable.get(key)
+    if idx is None:
+        idx = find_latest_installable_release(p, bin_name, max_api)
+        latest_installable[key] = idx
+    if idx < 0:
+        return (-1, None)
+    return (idx, p['releases'][idx])
 
 def get_latest_installable_release(p: MutableMapping) -> Optional[MutableMapping]:
     return get_latest_installable_release_with_index(p)[1]
@@ -444,6 +730,18 @@ def get_latest_installable_release(p: MutableMapping) -> Optional[MutableMapping
 def can_install(p: MutableMapping) -> bool:
     return get_latest_installable_release(p) is not None
 
+# identifier -> (index, release) to install instead of the latest one, filled from a lockfile
+pinned_releases: MutableMapping = {}
+
+def get_install_release_with_index(p: MutableMapping) -> Tuple[int, Optional[MutableMapping]]:
+    pinned = pinned_releases.get(p['identifier'])
+    if pinned is not None:
+        return pinned
+    return get_latest_installable_release_with_index(p)
+
+def get_install_release(p: MutableMapping) -> Optional[MutableMapping]:
+    return get_install_release_with_index(p)[1]
+
 
 def make_pyversion(version: str, index: int) -> str:
     PEP440REGEX = re.compile(r"(\d+!)?\d+(\.\d+)*((?:a|b|rc)\d+)?(\.post\d+)?(\.dev\d+)?(\+[a-zA-Z0-9]+)?")
@@ -537,17 +835,50 @@ Platform: All""")
             w.writerow([filename, sha256hex, length])
 
 
+def copy_and_hash(src: io.BufferedIOBase, dst_fn: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(dst_fn, 'wb') as dst:
+        for block in iter(lambda: src.read(1024*1024), b''):
+            file_hash.update(block)
+            dst.write(block)
+    return file_hash.hexdigest()
+
+def extract_files(archive_path: str, archive_files: MutableMapping, staging_path: str) -> None:
+    # Extracts all listed files in a single pass into staging_path, laid out by install name, and verifies their hashes
+    for install_fn in archive_files:
+        os.makedirs(os.path.join(staging_path, os.path.split(install_fn)[0]), exist_ok=True)
+
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path, 'r') as zf:
+            names = set(zf.namelist())
+            if all(fn_props[0].replace('\\', '/') in names for fn_props in archive_files.values()):
+                for install_fn, fn_props in archive_files.items():
+                    with zf.open(fn_props[0].replace('\\', '/')) as src:
+                        file_hash = copy_and_hash(src, os.path.join(staging_path, install_fn))
+                    if file_hash != fn_props[1]:
+                        raise Exception('Hash mismatch for ' + install_fn + ' got ' + file_hash + ' but expected ' + fn_props[1])
+                return
+
+    extract_path = os.path.join(staging_path, '.7z')
+    result = subprocess.run([cmd7zip_path, "x", "-y", "-o" + extract_path, archive_path] + [fn_props[0] for fn_props in archive_files.values()], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    result.check_returncode()
+    for install_fn, fn_props in archive_files.items():
+        extracted_fn = os.path.join(extract_path, fn_props[0])
+        file_hash = hash_file(extracted_fn)
+        if file_hash != fn_props[1]:
+            raise Exception('Hash mismatch for ' + install_fn + ' got ' + file_hash + ' but expected ' + fn_props[1])
+        shutil.copyfile(extracted_fn, os.path.join(staging_path, install_fn))
+
 def install_files(p: MutableMapping) -> Tuple[int, int]:
     err = (0, 1)
     dest_path = get_install_path(p)
     bin_name = get_bin_name(p)
-    idx, install_rel = get_latest_installable_release_with_index(p)
+    idx, install_rel = get_install_release_with_index(p)
     if install_rel is None:
         return err
     url = install_rel[bin_name]['url']
-    data: Optional[bytearray] = None
     try:
-        data = fetch_url_cached(url, p['name'] + ' ' + install_rel['version'])
+        archive_path, archive_hash = fetch_release(p, install_rel)
     except:
         print('Failed to download ' + p['name'] + ' ' + install_rel['version'] + ', skipping installation and moving on')
         return err
@@ -556,10 +887,9 @@ def install_files(p: MutableMapping) -> Tuple[int, int]:
 
     if bin_name == 'wheel':
         try:
-            hash_result = check_hash(data, install_rel[bin_name]['hash'])
-            if not hash_result[0]:
-                raise ValueError('Hash mismatch for ' + url + ' got ' + hash_result[1] + ' but expected ' + hash_result[2])
-            with zipfile.ZipFile(io.BytesIO(data), 'r') as zf:
+            if archive_hash != install_rel[bin_name]['hash']:
+                raise ValueError('Hash mismatch for ' + url + ' got ' + archive_hash + ' but expected ' + install_rel[bin_name]['hash'])
+            with zipfile.ZipFile(archive_path, 'r') as zf:
                 basename: Optional[str] = None
                 for fn in zf.namelist():
                     if fn.endswith('.dist-info/WHEEL'):
@@ -599,104 +929,256 @@ def install_files(p: MutableMapping) -> Tuple[int, int]:
                 single_file = (key, install_rel[bin_name]['files'][key][0], install_rel[bin_name]['files'][key][1])
         if (single_file is not None) and (single_file[1] == url.rsplit('/', 2)[-1]):
             install_fn = single_file[0]
-            hash_result = check_hash(data, single_file[2])
-            if not hash_result[0]:
-                raise Exception('Hash mismatch for ' + install_fn + ' got ' + hash_result[1] + ' but expected ' + hash_result[2])
+            if archive_hash != single_file[2]:
+                raise Exception('Hash mismatch for ' + install_fn + ' got ' + archive_hash + ' but expected ' + single_file[2])
             uninstall_files(p)
             os.makedirs(os.path.join(dest_path, os.path.split(install_fn)[0]), exist_ok=True)
-            with open(os.path.join(dest_path, install_fn), 'wb') as outfile:
-                files.append((os.path.join(dest_path, install_fn), single_file[2], str(len(data))))
-                outfile.write(data)
+            shutil.copyfile(archive_path, os.path.join(dest_path, install_fn))
+            files.append((os.path.join(dest_path, install_fn), single_file[2], str(os.path.getsize(archive_path))))
         else:
-            tffd, tfpath = tempfile.mkstemp(prefix='vsm')
-            with open(tffd, mode='wb') as tf:
-                tf.write(data)
-            result_cache = {}
-            for install_fn in install_rel[bin_name]['files']:
-                fn_props = install_rel[bin_name]['files'][install_fn]
-                result = subprocess.run([cmd7zip_path, "e", "-so", tfpath, fn_props[0]], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                result.check_returncode()
-                hash_result = check_hash(result.stdout, fn_props[1])
-                if not hash_result[0]:
-                    raise Exception('Hash mismatch for ' + install_fn + ' got ' + hash_result[1] + ' but expected ' + hash_result[2])
-                result_cache[install_fn] = (result.stdout, fn_props[1])
-            uninstall_files(p)
-            for install_fn in install_rel[bin_name]['files']:
-                os.makedirs(os.path.join(dest_path, os.path.split(install_fn)[0]), exist_ok=True)
-                with open(os.path.join(dest_path, install_fn), 'wb') as outfile:
-                    files.append((os.path.join(dest_path, install_fn), str(result_cache[install_fn][1]), str(len(result_cache[install_fn][0]))))
-                    outfile.write(result_cache[install_fn][0])
-            os.remove(tfpath)
-
+            staging_path = tempfile.mkdtemp(prefix='vsm', dir=cache_path)
+            try:
+                with archive_locks.setdefault(url, threading.Lock()):
+                    # Another package using the same archive may have moved it into the cache meanwhile
+                    archive_path = download_cache.get(url, (archive_path,))[0]
+                    try:
+                        extract_files(archive_path, install_rel[bin_name]['files'], staging_path)
+                    except BaseException:
+                        discard_download(url, archive_path)
+                        raise
+                    cache_verified_download(archive_path)
+                uninstall_files(p)
+                for install_fn, fn_props in install_rel[bin_name]['files'].items():
+                    os.makedirs(os.path.join(dest_path, os.path.split(install_fn)[0]), exist_ok=True)
+                    shutil.move(os.path.join(staging_path, install_fn), os.path.join(dest_path, install_fn))
+                    files.append((os.path.join(dest_path, install_fn), str(fn_props[1]), str(os.path.getsize(os.path.join(dest_path, install_fn)))))
+            finally:
+                shutil.rmtree(staging_path, ignore_errors=True)
+
+        record_installed_files(p, install_rel['version'], files)
         install_package_meta(files, p, install_rel, idx)
 
     installed_packages[p['identifier']] = install_rel['version']
+    mark_stubs_changed(p)
     print('Successfully installed ' + p['name'] + ' ' + install_rel['version'])
     return (1, 0)
 
-def install_package(name: str) -> Tuple[int, int, int]:
-    p = get_package_from_name(name)
-    if get_vapoursynth_api_version() <= 3:
-        if p['identifier'] in bundled_api3_plugins:
+def build_install_graph(names: List[str], include_installed: bool = False, upgrade_ids: Optional[set] = None) -> MutableMapping:
+    # identifier -> (package, identifiers of the graph packages it depends on), only for
+    # packages that still have to be installed, or upgraded when listed in upgrade_ids
+    nodes: MutableMapping = {}
+    seen: set = set()
+    pending = list(reversed(names))
+    while len(pending) > 0:
+        p = get_package_from_name(pending.pop())
+        if p['identifier'] in seen:
+            continue
+        seen.add(p['identifier'])
+        if get_vapoursynth_api_version() <= 3 and p['identifier'] in bundled_api3_plugins:
             print('Binaries are already bundled for ' + p['name'] + ', skipping installation')
-            return (0, 0, 0)
-    if can_install(p):
-        inst = (0, 0, 0)
-        if not args.skip_deps:
-            if 'dependencies' in p:
-                for dep in p['dependencies']:
-                    if not isinstance(dep, str):
-                        continue
-                    res = install_package(dep)
-                    inst = (inst[0], inst[1] + res[0] + res[1], inst[2] + res[2])
-        if not is_package_installed(p['identifier']):
-            fres = install_files(p)
-            inst = (inst[0] + fres[0], inst[1], inst[2] + fres[1])
-        return inst
-    else:
-        print('No binaries available for ' + args.target + ' in package ' + p['name'] + ', skipping installation')
-        return (0, 0, 1)
-
-def upgrade_files(p: MutableMapping) -> Tuple[int, int, int]:
-    if can_install(p):
-        inst = (0, 0, 0)
-        if 'dependencies' in p:
-            for dep in p['dependencies']:
-                if not is_package_installed(dep):
-                    res = install_package(dep)
-                    inst = (inst[0], inst[1] + res[0] + res[1], inst[2] + res[2])
-        fres = install_files(p)
-        return (inst[0] + fres[0], inst[1], inst[2] + fres[1])
-    else:
-        print('No binaries available for ' + args.target + ' in package ' + p['name'] + ', skipping installation')
-        return (0, 0, 1)
+            continue
+        deps: List[str] = []
+        # Packages without binaries stay in the graph so their dependents are not installed either
+        if can_install(p) and not args.skip_deps and 'dependencies' in p:
+            deps = [get_package_from_name(dep)['identifier'] for dep in p['dependencies'] if isinstance(dep, str)]
+            pending.extend(reversed(deps))
+        if include_installed or not is_package_installed(p['identifier']) or (upgrade_ids is not None and p['identifier'] in upgrade_ids):
+            nodes[p['identifier']] = (p, deps)
+    return {id: (p, [dep for dep in deps if dep in nodes]) for id, (p, deps) in nodes.items()}
+
+def schedule_install_graph(graph: MutableMapping) -> List[List[str]]:
+    # Kahn's algorithm, every stage only depends on earlier stages
+    waiting = {id: set(deps) for id, (_, deps) in graph.items()}
+    stages: List[List[str]] = []
+    while len(waiting) > 0:
+        stage = [id for id, deps in waiting.items() if len(deps) == 0]
+        if len(stage) == 0:
+            raise ValueError('Dependency cycle between ' + ', '.join(sorted(graph[id][0]['name'] for id in waiting)))
+        for id in stage:
+            del waiting[id]
+        for deps in waiting.values():
+            deps.difference_update(stage)
+        stages.append(stage)
+    return stages
+
+def get_download_size(p: MutableMapping) -> Optional[int]:
+    # Bytes still to download, None if the server doesn't say
+    rel = get_install_release(p)
+    if rel is None:
+        return 0
+    url = rel[get_bin_name(p)]['url']
+    if url in download_cache or os.path.isfile(os.path.join(cache_path, get_release_cache_key(p, rel)[0])):
+        return 0
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, method='HEAD')) as urlreq:
+            size = urlreq.headers['content-length']
+            return int(size) if size is not None else None
+    except Exception:
+        return None
 
-def upgrade_package(name, force) -> Tuple[int, int, int]:
-    inst = (0, 0, 0)
-    p = get_package_from_name(name)
-    if not is_package_installed(p['identifier']):
-        print('Package ' + p['name'] + ' not installed, can\'t upgrade')
-    elif is_package_upgradable(p['identifier'], force):
-        res = upgrade_files(p)
-        return (res[0], 0, res[1])
-    elif not is_package_upgradable(p['identifier'], True):
-        print('Package ' + p['name'] + ' not upgraded, latest version installed')
-    else:
-        print('Package ' + p['name'] + ' not upgraded, unknown version must use -f to force replacement')
-    return inst
+def format_size(size: int) -> str:
+    if size < 1024 * 1024:
+        return '{:.1f} KiB'.format(size / 1024)
+    return '{:.1f} MiB'.format(size / (1024 * 1024))
+
+def print_install_plan(graph: MutableMapping) -> None:
+    stages = schedule_install_graph(graph)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+        sizes = dict(zip(graph.keys(), executor.map(get_download_size, [p for p, _ in graph.values()])))
+
+    print('{} {} in {} {}'.format(len(graph), 'package' if len(graph) == 1 else 'packages', len(stages), 'stage' if len(stages) == 1 else 'stages'))
+    for stage_idx, stage in enumerate(stages):
+        for id in stage:
+            p = graph[id][0]
+            rel = get_install_release(p)
+            if rel is None:
+                size_str = 'no binaries'
+            elif sizes[id] is None:
+                size_str = 'unknown size'
+            elif sizes[id] == 0:
+                size_str = 'cached'
+            else:
+                size_str = format_size(sizes[id])
+            print('{:5d} {:25s} {:11s} {:s}'.format(stage_idx + 1, p['name'], rel['version'] if rel is not None else '', size_str))
+
+    unknown = sum(1 for size in sizes.values() if size is None)
+    print('Estimated download: {}{}'.format(format_size(sum(size for size in sizes.values() if size is not None)), ' and {} of unknown size'.format(unknown) if unknown > 0 else ''))
 
-def upgrade_all_packages(force: bool) -> Tuple[int, int, int]:
+# Wheels all extract into site-packages, so only one is installed at a time
+wheel_lock = threading.Lock()
+
+def install_graph_node(p: MutableMapping) -> Tuple[int, int]:
+    if not can_install(p):
+        print('No binaries available for ' + args.target + ' in package ' + p['name'] + ', skipping installation')
+        return (0, 1)
+    try:
+        if p['type'] == 'PyWheel':
+            with wheel_lock:
+                return install_files(p)
+        return install_files(p)
+    except Exception as e:
+        print('Failed to install ' + p['name'] + ' with error: ' + str(e))
+        return (0, 1)
+
+def install_graph(graph: MutableMapping, root_ids: List[str]) -> Tuple[int, int, int]:
+    # Installs every package as soon as its dependencies are in place, independent
+    # subtrees run concurrently. Returns (requested packages, dependencies, failures)
+    schedule_install_graph(graph)
+    waiting = {id: set(deps) for id, (_, deps) in graph.items()}
     inst = (0, 0, 0)
-    installed_ids: List[str] = list(installed_packages.keys())
-    for id in installed_ids:
-        if is_package_upgradable(id, force):
-            pkg = get_package_from_id(id, True)
-            if pkg is None:
-                return inst
-            res = upgrade_files(pkg)
-            inst = (inst[0] + res[0], inst[1] + res[1], inst[2] + res[2])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+        running: MutableMapping = {}
+        while len(waiting) > 0 or len(running) > 0:
+            for id in [id for id, deps in waiting.items() if len(deps) == 0]:
+                del waiting[id]
+                running[executor.submit(install_graph_node, graph[id][0])] = id
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                id = running.pop(future)
+                res = future.result()
+                if id in root_ids:
+                    inst = (inst[0] + res[0], inst[1], inst[2] + res[1])
+                else:
+                    inst = (inst[0], inst[1] + res[0], inst[2] + res[1])
+                if res[0] > 0:
+                    for deps in waiting.values():
+                        deps.discard(id)
+                    continue
+                # Nothing that needs the failed package gets installed
+                failed = [id]
+                while len(failed) > 0:
+                    failed_id = failed.pop()
+                    for dependent_id in [dependent_id for dependent_id, deps in waiting.items() if failed_id in deps]:
+                        del waiting[dependent_id]
+                        print('Skipping ' + graph[dependent_id][0]['name'] + ', dependency ' + graph[failed_id][0]['name'] + ' failed')
+                        inst = (inst[0], inst[1], inst[2] + 1)
+                        failed.append(dependent_id)
     return inst
 
+def get_upgradable_ids(names: List[str], force: bool) -> List[str]:
+    upgrade_ids: List[str] = []
+    for name in names:
+        p = get_package_from_name(name)
+        if not is_package_installed(p['identifier']):
+            print('Package ' + p['name'] + ' not installed, can\'t upgrade')
+        elif is_package_upgradable(p['identifier'], force):
+            upgrade_ids.append(p['identifier'])
+        elif not is_package_upgradable(p['identifier'], True):
+            print('Package ' + p['name'] + ' not upgraded, latest version installed')
+        else:
+            print('Package ' + p['name'] + ' not upgraded, unknown version must use -f to force replacement')
+    return upgrade_ids
+
+def get_release_hashes(p: MutableMapping, rel: MutableMapping) -> MutableMapping:
+    bin_name = get_bin_name(p)
+    hashes = {fn: fn_props[1] for fn, fn_props in rel[bin_name].get('files', {}).items()}
+    if 'hash' in rel[bin_name]:
+        hashes[rel[bin_name]['url'].rsplit('/', 1)[-1]] = rel[bin_name]['hash']
+    return hashes
+
+def write_lockfile(path: str) -> int:
+    packages: MutableMapping = {}
+    for id, version in sorted(installed_packages.items()):
+        p = get_package_from_name(id)
+        rel = next((rel for rel in p['releases'] if rel['version'] == version), None) if version != 'Unknown' else None
+        if rel is None or get_bin_name(p) not in rel:
+            print('Can\'t lock unknown version of package: ' + p['name'])
+            continue
+        packages[id] = {'version': version, 'hashes': get_release_hashes(p, rel)}
+    with open(path, 'w', encoding='utf-8') as lf:
+        json.dump({'file-format': 1, 'target': args.target, 'packages': packages}, lf, indent=2)
+    return len(packages)
+
+def read_lockfile(path: str) -> MutableMapping:
+    # Pins every locked release and returns identifier -> version
+    with open(path, 'r', encoding='utf-8') as lf:
+        lock = json.load(lf)
+    if lock.get('file-format') != 1:
+        raise ValueError('Lockfile format is {} but only version 1 is supported'.format(lock.get('file-format')))
+    if lock['target'] != args.target:
+        raise ValueError('Lockfile is for {} but the target is {}'.format(lock['target'], args.target))
+    for id, locked in lock['packages'].items():
+        p = get_package_from_name(id)
+        found = next(((idx, rel) for idx, rel in enumerate(p['releases']) if rel['version'] == locked['version']), None)
+        if found is None or get_bin_name(p) not in found[1]:
+            raise ValueError('No {} release of {} available for {}'.format(locked['version'], p['name'], args.target))
+        # The same version must still mean the same files
+        if get_release_hashes(p, found[1]) != locked['hashes']:
+            raise ValueError('Hashes of {} {} differ from the lockfile'.format(p['name'], locked['version']))
+        pinned_releases[id] = found
+    return {id: locked['version'] for id, locked in lock['packages'].items()}
+
+def prefetch_packages(pkgs: List[MutableMapping]) -> Tuple[int, int]:
+    # Download everything up front through a bounded pool, the installs that
+    # follow read the archives from download_cache
+    downloads = []
+    for p in pkgs:
+        rel = get_install_release(p)
+        if rel is None:
+            continue
+        url = rel[get_bin_name(p)]['url']
+        if url not in download_cache and all(url != d[1][get_bin_name(d[0])]['url'] for d in downloads):
+            downloads.append((p, rel))
+    if len(downloads) == 0:
+        return (0, 0)
+
+    fetched = 0
+    progress = tqdm.tqdm(total=0, unit='B', unit_scale=True, unit_divisor=1024, desc='Downloading {} packages'.format(len(downloads))) if 'tqdm' in sys.modules else None
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+            futures = [executor.submit(fetch_release, p, rel, progress) for p, rel in downloads]
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                    fetched += 1
+                except Exception:
+                    # Reported again when the install itself retries the download
+                    pass
+    finally:
+        if progress is not None:
+            progress.close()
+    return (fetched, len(downloads) - fetched)
+
 def uninstall_files(p: MutableMapping) -> None:
     dest_path = get_install_path(p)
     bin_name = get_bin_name(p)
@@ -729,6 +1211,7 @@ def uninstall_files(p: MutableMapping) -> None:
         if installed_rel is not None:
             for f in installed_rel[bin_name]['files']:
                 os.remove(os.path.join(dest_path, f))
+            forget_installed_files(p, [os.path.join(dest_path, f) for f in installed_rel[bin_name]['files']])
 
         remove_package_meta(p)
 
@@ -740,6 +1223,7 @@ def uninstall_package(name: str) -> Tuple[int, int]:
             return (0, 0)
         else:
             uninstall_files(p)
+            mark_stubs_changed(p, True)
             print('Uninstalled package: ' + p['name'] + ' ' + installed_packages[p['identifier']])
             return (1, 0)
     else:
@@ -770,6 +1254,7 @@ def update_package_definition(url: str) -> None:
             raise
     else:
         print('Local definitions updated to: ' + email.utils.formatdate(remote_modtime, usegmt=True))
+        load_package_list()
 
 
 def get_vapoursynth_version() -> int:
@@ -794,14 +1279,41 @@ def get_vapoursynth_api_version() -> int:
     return 3
 
 
-def update_genstubs() -> None:
+def update_genstubs(namespaces: Optional[List[str]] = None) -> None:
     sys.path.append(os.path.dirname(__file__))
 
     from vsgenstubs4 import main as genstubs4
 
     print("Updating VapourSynth stubs")
 
-    genstubs4([])
+    genstubs4(namespaces if namespaces is not None else [])
+
+def mark_stubs_changed(p: MutableMapping, removed: bool = False) -> None:
+    # Scripts and wheels add no plugin functions, only binaries change the stubs
+    if p['type'] != 'VSPlugin':
+        return
+    if removed:
+        removed_stub_namespaces.add(p['namespace'])
+    else:
+        changed_stub_namespaces.add(p['namespace'])
+
+def update_changed_stubs() -> None:
+    # Called once at the end of an operation, regenerates only the namespaces it touched
+    if len(changed_stub_namespaces) == 0 and len(removed_stub_namespaces) == 0:
+        return
+    if args.defer_stubs:
+        print('VapourSynth stubs not updated, run genstubs when done')
+        return
+    stub_path = os.path.join(os.path.dirname(detect_vapoursynth_installation()), 'vapoursynth-stubs', '__init__.pyi')
+    # Removed plugins can only be dropped by a full run
+    if len(removed_stub_namespaces) > 0 or not os.path.isfile(stub_path):
+        update_genstubs()
+        return
+    try:
+        update_genstubs(sorted(changed_stub_namespaces))
+    except ModuleNotFoundError:
+        # A plugin that failed to load, let the full run skip it
+        update_genstubs()
 
 def rebuild_distinfo() -> None:
     print("Rebuilding dist-info dirs for other python package installers")
@@ -834,13 +1346,14 @@ def print_paths():
     print('Definitions: ' + package_json_path)
     print('Binaries: ' + plugin_path)
     print('Scripts: ' + py_script_path)
+    print('Download cache: ' + cache_path)
 
     if site_package_dir is not None:
         print("Dist-Infos: " + site_package_dir)
     else:
         print("Dist-Infos: <Will not be installed>")
 
-if args.operation != 'update' and package_list is None:
+if args.operation not in ('update', 'paths') and package_list is None:
     print('Failed to open vspackages3.json. Run update command.')
     sys.exit(1)
 
@@ -854,14 +1367,22 @@ for name in args.package:
 
 if args.operation == 'install':
     detect_installed_packages()
+    graph = build_install_graph(args.package)
+    try:
+        schedule_install_graph(graph)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    if args.dry_run:
+        print_install_plan(graph)
+        sys.exit(0)
     rebuild_distinfo()
 
-    inst = (0, 0, 0)
-    for name in args.package:
-        res = install_package(name)
-        inst = (inst[0] + res[0], inst[1] + res[1], inst[2] + res[2])
+    prefetch_packages([p for p, _ in graph.values()])
 
-    update_genstubs()
+    inst = install_graph(graph, [get_package_from_name(name)['identifier'] for name in args.package])
+
+    update_changed_stubs()
 
     if (inst[0] == 0) and (inst[1] == 0):
         print('Nothing done')
@@ -875,17 +1396,26 @@ if args.operation == 'install':
         print('{} {} failed'.format(inst[2], 'package' if inst[0] == 1 else 'packages'))
 elif args.operation in ('upgrade', 'upgrade-all'):
     detect_installed_packages()
-    rebuild_distinfo()
-
-    inst = (0, 0, 0)
     if args.operation == 'upgrade-all':
-        inst = upgrade_all_packages(args.force)
+        upgrade_ids = [id for id in installed_packages if is_package_upgradable(id, args.force)]
     else:
-        for name in args.package:
-            res = upgrade_package(name, args.force)
-            inst = (inst[0] + res[0], inst[1] + res[1], inst[2] + res[2])
+        upgrade_ids = get_upgradable_ids(args.package, args.force)
+    graph = build_install_graph(upgrade_ids, upgrade_ids=set(upgrade_ids))
+    try:
+        schedule_install_graph(graph)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    if args.dry_run:
+        print_install_plan(graph)
+        sys.exit(0)
+    rebuild_distinfo()
 
-    update_genstubs()
+    prefetch_packages([p for p, _ in graph.values()])
+
+    inst = install_graph(graph, upgrade_ids)
+
+    update_changed_stubs()
 
     if (inst[0] == 0) and (inst[1] == 0):
         print('Nothing done')
@@ -907,7 +1437,7 @@ elif args.operation == 'uninstall':
         print('No packages uninstalled')
     else:
         print('{} {} uninstalled'.format(uninst[0], 'package' if uninst[0] == 1 else 'packages'))
-    update_genstubs()
+    update_changed_stubs()
 elif args.operation == 'installed':
     detect_installed_packages()
     list_installed_packages()
@@ -923,6 +1453,56 @@ elif args.operation == "genstubs":
 elif args.operation == "gendistinfo":
     detect_installed_packages()
     rebuild_distinfo()
+elif args.operation == 'lock':
+    detect_installed_packages()
+    locked = write_lockfile(args.lockfile)
+    print('{} {} locked in {}'.format(locked, 'package' if locked == 1 else 'packages', args.lockfile))
+elif args.operation == 'sync':
+    detect_installed_packages()
+    try:
+        locked_versions = read_lockfile(args.lockfile)
+    except (OSError, ValueError, KeyError) as e:
+        print('Failed to read lockfile ' + args.lockfile + ': ' + str(e))
+        sys.exit(1)
+    sync_ids = [id for id, version in locked_versions.items() if installed_packages.get(id) != version]
+    prune_ids = [id for id in installed_packages if id not in locked_versions] if args.prune else []
+    graph = build_install_graph(sync_ids, upgrade_ids=set(sync_ids))
+    try:
+        schedule_install_graph(graph)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    if args.dry_run:
+        for id in prune_ids:
+            print('Uninstall ' + get_package_from_name(id)['name'] + ' ' + installed_packages[id])
+        print_install_plan(graph)
+        sys.exit(0)
+
+    rebuild_distinfo()
+
+    uninst = (0, 0)
+    for id in prune_ids:
+        uninst_res = uninstall_package(id)
+        uninst = (uninst[0] + uninst_res[0], uninst[1] + uninst_res[1])
+
+    prefetch_packages([p for p, _ in graph.values()])
+    inst = install_graph(graph, sync_ids)
+
+    update_changed_stubs()
+
+    if inst[0] == 0 and inst[1] == 0 and uninst[0] == 0:
+        print('Already in sync with ' + args.lockfile)
+    else:
+        print('{} {} synced, {} {} uninstalled'.format(inst[0] + inst[1], 'package' if inst[0] + inst[1] == 1 else 'packages', uninst[0], 'package' if uninst[0] == 1 else 'packages'))
+    if inst[2] > 0:
+        print('{} {} failed'.format(inst[2], 'package' if inst[2] == 1 else 'packages'))
+elif args.operation == 'prefetch':
+    detect_installed_packages()
+    names = args.package if len(args.package) > 0 else list(installed_packages.keys())
+    fetched, failed = prefetch_packages([p for p, _ in build_install_graph(names, include_installed=True).values()])
+    print('{} {} in the download cache'.format(fetched, 'package' if fetched == 1 else 'packages'))
+    if failed > 0:
+        print('{} {} failed'.format(failed, 'package' if failed == 1 else 'packages'))
 
 
 def noop():
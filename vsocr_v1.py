@@ -1,5 +1,11 @@
+import importlib.util
 import os
+import queue
+import runpy
 import sys
+import tempfile
+import threading
+from typing import NamedTuple
 import pytesseract
 import vapoursynth as vs
 import numpy as np
@@ -26,17 +32,262 @@ def set_dark_theme(app):
     palette.setColor(QPalette.ColorRole.HighlightedText, Qt.GlobalColor.black)
     app.setPalette(palette)
 
+# vs.core is created lazily, the plugins are loaded only when a clip needs them
 core = vs.core
-ffms2 = os.path.join(current_dir, 'vapoursynth', 'vapoursynth64', 'plugins', 'ffms2')
-core.std.LoadPlugin(path=ffms2)
+FFMS2_PATH = os.path.join(current_dir, 'vapoursynth', 'vapoursynth64', 'plugins', 'ffms2')
 
-def detect_subtitles(frame):
-    # Use numpy to handle frame data
-    frame_array = np.asarray(frame[0])
+# Cache written by vsgenstubs4, for the checks that run before the core is needed.
+# Only this module is loaded, without putting the portable directory on sys.path
+CAPABILITIES_PATH = os.path.join(current_dir, 'vapoursynth', 'vsgenstubs4', 'capabilities.py')
+
+def import_load_capabilities():
+    if not os.path.isfile(CAPABILITIES_PATH):
+        return None
+    spec = importlib.util.spec_from_file_location('vsocr_capabilities', CAPABILITIES_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.load_capabilities
+
+load_capabilities = import_load_capabilities()
+
+def ensure_ffms2():
+    if not hasattr(core, 'ffms2'):
+        core.std.LoadPlugin(path=FFMS2_PATH)
+
+def get_source_filters():
+    # Offer the video formats only if a source filter is there to open them
+    filters = []
+    if (load_capabilities is not None and load_capabilities().has_plugin('ffms2')) or os.path.exists(FFMS2_PATH + '.dll'):
+        filters.append("Video Files (*.mkv *.mp4 *.avi)")
+    filters.append("VapourSynth Scripts (*.vpy)")
+    filters.append("All Files (*)")
+    return ";;".join(filters)
+
+IMAGE_EXTENSIONS = ('.png', '.tif', '.tiff', '.bmp', '.jpg', '.jpeg', '.webp')
+# Le sequenze di immagini non hanno timestamp, si assume questo framerate
+IMAGE_SEQUENCE_FPS = (24000, 1001)
+
+def load_script(script_path, index=0):
+    # Run a .vpy script in this environment and take its output node
+    vs.clear_outputs()
+    runpy.run_path(script_path, run_name='__vapoursynth__')
+    output = vs.get_output(index)
+    return output.clip if isinstance(output, vs.VideoOutputTuple) else output
+
+def load_image_sequence(directory, fps=IMAGE_SEQUENCE_FPS):
+    if not hasattr(core, 'imwri'):
+        raise RuntimeError('The imwri plugin is required to read image sequences')
+    files = sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    if not files:
+        raise ValueError(f'No images found in {directory}')
+    clip = core.imwri.Read(files)
+    return core.std.AssumeFPS(clip, fpsnum=fps[0], fpsden=fps[1])
+
+def build_timecodes(clip):
+    # Start time in milliseconds of every frame, plus the end time of the last one
+    if clip.fps.numerator > 0:
+        return np.arange(clip.num_frames + 1, dtype=np.float64) * (clip.fps.denominator * 1000 / clip.fps.numerator)
+    # Variable frame rate without a timecodes file, read the durations once
+    durations = np.empty(clip.num_frames, dtype=np.float64)
+    for n, frame in enumerate(clip.frames(close=True)):
+        durations[n] = frame.props['_DurationNum'] * 1000 / frame.props['_DurationDen']
+    return np.concatenate(([0.0], np.cumsum(durations)))
+
+def read_timecodes(timecodes_path, clip):
+    # Matroska timecodes v2, one start time in milliseconds per frame
+    with open(timecodes_path, encoding='utf-8') as f:
+        starts = [float(line) for line in f if line.strip() and not line.startswith('#')]
+    if len(starts) != clip.num_frames:
+        return build_timecodes(clip)
+    if len(starts) > 1:
+        last_duration = starts[-1] - starts[-2]
+    else:
+        last_duration = clip.fps.denominator * 1000 / clip.fps.numerator if clip.fps.numerator > 0 else 0.0
+    return np.array(starts + [starts[-1] + last_duration], dtype=np.float64)
+
+def load_source(source):
+    # Accept an already built node, a .vpy script, an image directory or a video file.
+    # Returns the clip and its timecode index
+    if isinstance(source, vs.VideoNode):
+        clip = source
+    elif os.path.isdir(source):
+        clip = load_image_sequence(source)
+    elif os.path.splitext(source)[1].lower() == '.vpy':
+        clip = load_script(source)
+    else:
+        # ffms2 writes the exact timecodes while indexing, no frame has to be read
+        ensure_ffms2()
+        tc_fd, tc_path = tempfile.mkstemp(prefix='vsocr', suffix='.txt')
+        os.close(tc_fd)
+        try:
+            clip = core.ffms2.Source(source, timecodes=tc_path)
+            return clip, read_timecodes(tc_path, clip)
+        finally:
+            os.remove(tc_path)
+    return clip, build_timecodes(clip)
+
+# Anime subtitles are usually a light fill with a dark outline, colours are 8 bit RGB
+SUBTITLE_FILL = (235, 235, 235)
+SUBTITLE_OUTLINE = (16, 16, 16)
+
+def _color_mask(planes, color, thr):
+    # 255 where every channel is within thr of the reference colour, 0 elsewhere
+    r, g, b = color
+    expr = f"x {r} - abs y {g} - abs max z {b} - abs max {thr} <= 255 0 ?"
+    return core.std.Expr(planes, expr=expr, format=vs.GRAY8)
+
+def _expand(clip, radius):
+    for _ in range(radius):
+        clip = core.std.Maximum(clip)
+    return clip
+
+def subtitle_mask(clip, fill=SUBTITLE_FILL, outline=SUBTITLE_OUTLINE, fill_thr=40, outline_thr=60, radius=2):
+    # Keep only fill-coloured pixels that lie next to outline-coloured pixels, so
+    # bright art behind the text is dropped, and return black text on a white GRAY8 clip
+    if clip.format.id != vs.RGB24:
+        clip = core.resize.Point(clip=clip, format=vs.RGB24)
+    planes = core.std.SplitPlanes(clip)
+    fill_mask = _color_mask(planes, fill, fill_thr)
+    outline_mask = _expand(_color_mask(planes, outline, outline_thr), radius)
+    return core.std.Expr([fill_mask, outline_mask], expr="x y and 0 255 ?")
+
+def detect_subtitles(image, lang='ita', config=''):
     # Use Pytesseract to recognize text directly from the numpy array
-    subtitle_text = pytesseract.image_to_string(frame_array, lang='ita')
+    subtitle_text = pytesseract.image_to_string(np.asarray(image), lang=lang, config=config)
     return subtitle_text
 
+class TesseractEngine:
+    def __init__(self, lang, config=''):
+        self.lang = lang
+        self.config = config
+
+    def __call__(self, image):
+        return detect_subtitles(image, self.lang, self.config)
+
+class OcrRegion(NamedTuple):
+    # top and bottom are fractions of the frame height
+    name: str
+    lang: str
+    top: float = 0.0
+    bottom: float = 1.0
+    config: str = ''
+
+# Es. dialoghi in basso e cartelli in alto:
+# [OcrRegion('dialogue', 'ita', 0.75, 1.0), OcrRegion('signs', 'jpn', 0.0, 0.2)]
+DEFAULT_REGIONS = (OcrRegion('dialogue', 'ita'),)
+
+def stack_regions(clip, regions, binarize=True):
+    # Crop every region out of the same source node and stack them, so one
+    # get_frame serves all regions and the video is decoded only once
+    if clip.format.id != vs.RGB24:
+        clip = core.resize.Point(clip=clip, format=vs.RGB24)
+    crops = []
+    rows = []
+    y = 0
+    for region in regions:
+        top = int(round(clip.height * region.top))
+        bottom = int(round(clip.height * region.bottom))
+        if bottom <= top:
+            raise ValueError(f'Region {region.name} is empty')
+        crop = core.std.Crop(clip, top=top, bottom=clip.height - bottom)
+        crops.append(subtitle_mask(crop) if binarize else crop)
+        rows.append((y, y + bottom - top))
+        y += bottom - top
+    stacked = crops[0] if len(crops) == 1 else core.std.StackVertical(crops)
+    return stacked, rows
+
+# Peak memory of one extraction job in megabytes, half of it goes to the
+# VapourSynth frame cache and the rest bounds the queues between the stages
+MEMORY_BUDGET = 1024
+
+def plan_memory(clip, budget=MEMORY_BUDGET):
+    fmt = clip.format
+    frame_bytes = clip.width * clip.height * fmt.bytes_per_sample * fmt.num_planes
+    cache_size = max(budget // 2, 1)
+    # Two queues and the frames() backlog, each holding at most depth frames
+    depth = max(1, (budget - cache_size) * 1024 * 1024 // (3 * frame_bytes))
+    return cache_size, depth
+
+def _put(q, item, stop):
+    # Blocks while the next stage is behind, gives up once the pipeline is stopped
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+def _decode_stage(clip, out_q, depth, stop):
+    try:
+        for n, frame in enumerate(clip.frames(backlog=depth)):
+            if not _put(out_q, (n, frame), stop):
+                frame.close()
+                return
+        _put(out_q, None, stop)
+    except BaseException as e:
+        _put(out_q, e, stop)
+
+def _preprocess_stage(in_q, out_q, stop):
+    try:
+        while True:
+            item = _get(in_q, stop)
+            if item is None or isinstance(item, BaseException):
+                _put(out_q, item, stop)
+                return
+            n, frame = item
+            # Copy the plane out and release the frame straight away
+            image = np.array(frame[0], copy=True)
+            frame.close()
+            if not _put(out_q, (n, image), stop):
+                return
+    except BaseException as e:
+        _put(out_q, e, stop)
+
+def iter_frame_images(clip, budget=MEMORY_BUDGET):
+    # Decode -> preprocess -> caller, with bounded queues so a slow OCR stage
+    # applies backpressure instead of piling frames up in memory
+    cache_size, depth = plan_memory(clip, budget)
+    core.max_cache_size = cache_size
+    decoded = queue.Queue(maxsize=depth)
+    images = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    workers = [
+        threading.Thread(target=_decode_stage, args=(clip, decoded, depth, stop), daemon=True),
+        threading.Thread(target=_preprocess_stage, args=(decoded, images, stop), daemon=True),
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        while True:
+            try:
+                item = images.get(timeout=0.1)
+            except queue.Empty:
+                # Every stage reports its end or its error, a dead one without a result is a bug
+                if workers[-1].is_alive() or not images.empty():
+                    continue
+                raise RuntimeError('The frame pipeline stopped without a result')
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join()
+
 def milliseconds_to_srt_time(milliseconds):
     seconds, milliseconds = divmod(milliseconds, 1000)
     minutes, seconds = divmod(seconds, 60)
@@ -48,40 +299,71 @@ def write_subtitle_to_srt(srt_file, index, start_time, end_time, subtitle_text):
     end_time_str = milliseconds_to_srt_time(end_time)
     srt_file.write(f"{index}\n{start_time_str} --> {end_time_str}\n{subtitle_text}\n\n")
 
+class SubtitleTrack:
+    # One output track per region, with its own engine and duplicate filter
+    def __init__(self, region, srt_file):
+        self.region = region
+        self.engine = TesseractEngine(region.lang, region.config)
+        self.srt_file = srt_file
+        self.prev_subs = None
+        self.all_subtitles = []
+
+    def feed(self, image, start_time, end_time):
+        subtitle_text = self.engine(image)
+
+        # Check if the subtitle is the same as the previous one to avoid duplicates
+        if subtitle_text and (not self.prev_subs or subtitle_text != self.prev_subs[2]):
+            write_subtitle_to_srt(self.srt_file, len(self.all_subtitles) + 1, start_time, end_time, subtitle_text)
+            self.all_subtitles.append((start_time, end_time, subtitle_text))
+
+        self.prev_subs = (start_time, end_time, subtitle_text) if subtitle_text else self.prev_subs
+
 class ExtractSubtitlesThread(QThread):
     update_status = pyqtSignal(str)
 
-    def __init__(self, video_path):
+    def __init__(self, source, binarize=True, memory_budget=MEMORY_BUDGET, regions=DEFAULT_REGIONS, output_base=None):
         super().__init__()
-        self.video_path = video_path
+        self.source = source
+        self.output_base = output_base
+        self.binarize = binarize
+        self.memory_budget = memory_budget
+        self.regions = regions
 
-    def run(self):
-        srt_file_path = os.path.splitext(self.video_path)[0] + ".srt"
-        # Carica il video e convertilo in RGB
-        video = core.ffms2.Source(self.video_path)
-        if video.format.color_family != vs.RGB:
-            video = core.resize.Point(clip=video, format=vs.RGB24)
-        prev_subs = None
-        all_subtitles = []
+    def srt_paths(self):
+        base = self.output_base
+        if base is None:
+            if isinstance(self.source, vs.VideoNode):
+                raise ValueError('output_base is required when extracting from a VideoNode')
+            if os.path.isdir(self.source):
+                base = os.path.normpath(self.source)
+            else:
+                base = os.path.splitext(self.source)[0]
+        if len(self.regions) == 1:
+            return [base + ".srt"]
+        return [f"{base}.{region.name}.srt" for region in self.regions]
 
-        with open(srt_file_path, "w", encoding="utf-8") as srt_file:
-            frame_num = video.num_frames
+    def run(self):
+        srt_file_paths = self.srt_paths()
+        # Carica il video una sola volta per tutte le regioni
+        video, timecodes = load_source(self.source)
+        # Binarizza nel grafo di VapourSynth, Tesseract riceve solo il testo
+        video, rows = stack_regions(video, self.regions, self.binarize)
 
-            for n in range(frame_num):
-                frame = video.get_frame(n)
-                frame_time = int(frame.props['_DurationNum'] * 1000 / frame.props['_DurationDen'])
-                subtitle_text = detect_subtitles(frame)
-                start_time = n * frame_time
-                end_time = start_time + frame_time
+        srt_files = [open(path, "w", encoding="utf-8") for path in srt_file_paths]
+        try:
+            tracks = [SubtitleTrack(region, srt_file) for region, srt_file in zip(self.regions, srt_files)]
 
-                # Check if the subtitle is the same as the previous one to avoid duplicates
-                if subtitle_text and (not prev_subs or subtitle_text != prev_subs[2]):
-                    write_subtitle_to_srt(srt_file, len(all_subtitles) + 1, start_time, end_time, subtitle_text)
-                    all_subtitles.append((start_time, end_time, subtitle_text))
+            for n, image in iter_frame_images(video, self.memory_budget):
+                start_time = int(round(timecodes[n]))
+                end_time = int(round(timecodes[n + 1]))
 
-                prev_subs = (start_time, end_time, subtitle_text) if subtitle_text else prev_subs
+                for track, (top, bottom) in zip(tracks, rows):
+                    track.feed(image[top:bottom], start_time, end_time)
+        finally:
+            for srt_file in srt_files:
+                srt_file.close()
 
-        self.update_status.emit(f"Status: Subtitles extracted and saved to {srt_file_path}.")
+        self.update_status.emit(f"Status: Subtitles extracted and saved to {', '.join(srt_file_paths)}.")
 
 class SubtitleExtractor(QtWidgets.QMainWindow):
     def __init__(self):
@@ -126,13 +408,17 @@ class SubtitleExtractor(QtWidgets.QMainWindow):
         self.setCentralWidget(main_widget)
 
     def select_file(self):
-        video_file, _ = QFileDialog.getOpenFileName(self, "Seleziona file video", "", "Video Files (*.mkv *.mp4 *.avi);;All Files (*)")
+        video_file, _ = QFileDialog.getOpenFileName(self, "Seleziona file video", "", get_source_filters())
         if video_file:
             self.file_path_display.setText(video_file)
             self.video_path = video_file
 
     def extractSubtitles(self):
         # Extract subtitles when the button is clicked
+        # Il percorso si puo' anche scrivere a mano, ad es. una cartella di immagini
+        typed_path = self.file_path_display.toPlainText().strip()
+        if typed_path:
+            self.video_path = typed_path
         if hasattr(self, 'video_path') and self.video_path:
             self.status_label.setText("Status: Processing...")
             self.extraction_thread = ExtractSubtitlesThread(self.video_path)